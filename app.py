@@ -1,35 +1,161 @@
 # Import required libraries
 import re
 from datetime import datetime
-from functools import cache
-from urllib.parse import quote_plus
 
 import gradio as gr
 import numpy as np
 from dotenv import dotenv_values
-from mixedbread import Mixedbread
-from pymilvus import MilvusClient
-import backoff
-import requests
+
+from caching import EmbeddingCache, LRUCache, SQLiteCache, normalize_text
+from crossref_client import CrossrefClient
+from dedup import abstract_hash
+from embed_batcher import EmbeddingBatcher
+from embedding_backend import create_embedding_backend, dense_to_binary
+from pipeline import AbstractNotFound, SearchPipeline, StageTimeout
+from request_trace import RequestTrace, StatsReporter, TraceSummary
+from rescore import Rescorer
+from result_cursor import MAX_SEARCH_WINDOW, ResultCursor
+from search_backend import create_backend
+from search_cache import SearchCache
 ################################################################################
 # Configuration
 
 # Get current year
 current_year = str(datetime.now().year)
 
-# Define Milvus client
-milvus_client = MilvusClient("http://localhost:19530")
-
-# Load Model
-# Model to use for embedding
-model_name = "mixedbread-ai/mxbai-embed-large-v1"
-
 # Import secrets
 config = dotenv_values(".env")
 
-# Setup mxbai client
-mxbai_api_key = config["MXBAI_API_KEY"]
-mxbai = Mixedbread(api_key=mxbai_api_key)
+# Define search backend, Milvus by default or the embedded local engine
+search_backend = create_backend(
+    config.get("SEARCH_BACKEND") or "milvus",
+    milvus_uri=config.get("MILVUS_URI") or "http://localhost:19530",
+    local_index_dir=config.get("LOCAL_INDEX_DIR") or "local_index",
+)
+
+# Define query embedding backend, the Mixedbread API by default or the model on
+# the local CPU through ONNX Runtime, which needs no network
+embedding_threads = config.get("EMBEDDING_THREADS")
+embedding_backend = create_embedding_backend(
+    config.get("EMBEDDING_BACKEND") or "mixedbread",
+    api_key=config.get("MXBAI_API_KEY"),
+    onnx_file=config.get("EMBEDDING_ONNX_FILE") or "onnx/model_quantized.onnx",
+    threads=int(embedding_threads) if embedding_threads else None,
+)
+
+# Micro-batch concurrent query embeddings: the first text waits up to
+# EMBED_BATCH_WINDOW_MS for others, up to EMBED_BATCH_SIZE go in one call
+embed_batch_options = {
+    "max_batch_size": int(config.get("EMBED_BATCH_SIZE") or 32),
+    "window_ms": float(config.get("EMBED_BATCH_WINDOW_MS") or 5),
+    "max_in_flight": int(config.get("EMBED_BATCH_IN_FLIGHT") or 4),
+}
+binary_batcher = EmbeddingBatcher(embedding_backend.embed_binary_batch, name="binary", **embed_batch_options)
+
+# Setup query embedding cache
+# Memory tier is bounded in bytes, disk tier is optional and survives restarts
+embedding_cache_ttl = config.get("EMBEDDING_CACHE_TTL")
+embedding_cache_path = config.get("EMBEDDING_CACHE_PATH")
+embedding_cache = EmbeddingCache(
+    memory=LRUCache(
+        max_bytes=int(config.get("EMBEDDING_CACHE_MAX_BYTES") or 32 * 1024 * 1024),
+        ttl=float(embedding_cache_ttl) if embedding_cache_ttl else None,
+    ),
+    disk=SQLiteCache(
+        embedding_cache_path,
+        table="embeddings",
+        ttl=float(embedding_cache_ttl) if embedding_cache_ttl else None,
+    ) if embedding_cache_path else None,
+)
+
+# Setup Crossref client with a pooled session and a persistent abstract cache
+crossref_client = CrossrefClient(
+    base_url=config.get("CROSSREF_API_URL") or "https://api.crossref.org",
+    cache_path=config.get("CROSSREF_CACHE_PATH") or None,
+    negative_ttl=float(config.get("CROSSREF_NEGATIVE_TTL") or 24 * 3600),
+    mailto=config.get("CROSSREF_MAILTO") or None,
+)
+
+# Rolling per-path latency summary of predict calls
+trace_summary = TraceSummary()
+
+# Statistics logged every STATS_INTERVAL seconds, 0 to disable
+stats_reporter = StatsReporter(interval=float(config.get("STATS_INTERVAL") or 60))
+stats_reporter.add("latency_by_path", trace_summary.stats)
+
+# Setup optional rescoring of binary candidates with float embeddings
+# Hamming search over-fetches RESCORE_FACTOR times the results, which are then
+# reranked with the float query embedding
+rescore_store_dir = config.get("RESCORE_STORE_DIR")
+rescorer = Rescorer.load(rescore_store_dir) if rescore_store_dir else None
+rescore_factor = int(config.get("RESCORE_FACTOR") or 4)
+
+# Float query embeddings are only asked for when rescoring
+float_batcher = EmbeddingBatcher(embedding_backend.embed_float_batch, name="float", **embed_batch_options) if rescorer else None
+
+# Float query embeddings are only needed for rescoring, cache them separately
+float_embedding_cache = EmbeddingCache(
+    memory=LRUCache(
+        max_bytes=int(config.get("EMBEDDING_CACHE_MAX_BYTES") or 32 * 1024 * 1024),
+        ttl=float(embedding_cache_ttl) if embedding_cache_ttl else None,
+    ),
+    disk=SQLiteCache(
+        embedding_cache_path,
+        table="float_embeddings",
+        ttl=float(embedding_cache_ttl) if embedding_cache_ttl else None,
+    ) if embedding_cache_path else None,
+)
+
+# Hits and misses of both tiers, logged with the other statistics
+stats_reporter.add("embedding_cache", embedding_cache.stats)
+stats_reporter.add("embedding_batches", binary_batcher.stats)
+if rescorer is not None:
+    stats_reporter.add("float_embedding_cache", float_embedding_cache.stats)
+    stats_reporter.add("float_embedding_batches", float_batcher.stats)
+
+# Setup hot document cache for the display fields of popular papers
+document_cache = LRUCache(
+    max_bytes=int(config.get("DOCUMENT_CACHE_MAX_BYTES") or 32 * 1024 * 1024),
+    ttl=float(config.get("DOCUMENT_CACHE_TTL") or 24 * 3600),
+    sizeof=lambda key, value: len(key) + sum(len(str(field)) for field in value.values()),
+)
+
+# Show papers sharing an abstract (preprint and published version, translations)
+# as one card listing the other DOIs
+group_duplicates = (config.get("GROUP_DUPLICATES") or "false").lower() == "true"
+
+# Setup search result cache, cleared when the collection changes
+search_cache_ttl = config.get("SEARCH_CACHE_TTL")
+search_cache = SearchCache(
+    max_bytes=int(config.get("SEARCH_CACHE_MAX_BYTES") or 64 * 1024 * 1024),
+    ttl=float(search_cache_ttl) if search_cache_ttl else None,
+    generation_fn=search_backend.generation,
+    check_interval=float(config.get("SEARCH_CACHE_CHECK_INTERVAL") or 30),
+)
+
+# Reranked candidates of a rescored search, (query, filter) -> (generation,
+# candidates fetched, whether there are more, reranked list), paged through so
+# every page comes from the same ranking
+reranked_cache = LRUCache(
+    max_bytes=int(config.get("SEARCH_CACHE_MAX_BYTES") or 64 * 1024 * 1024),
+    ttl=float(search_cache_ttl) if search_cache_ttl else None,
+    sizeof=lambda key, value: len(key[0]) + len(key[1]) + len(repr(value[2])),
+)
+
+# Request pipeline: seconds for a whole search and at most for each stage, and
+# how many calls may be in flight to each upstream at once
+request_deadline = float(config.get("REQUEST_DEADLINE") or 10)
+stage_timeouts = {
+    stage: float(config.get(f"{stage.upper()}_TIMEOUT") or default)
+    for stage, default in {"lookup": 2, "crossref": 5, "embed": 5, "search": 3, "render": 3}.items()
+}
+upstream_concurrency = {
+    upstream: int(config.get(f"{upstream.upper()}_CONCURRENCY") or default)
+    for upstream, default in {"milvus": 32, "crossref": 16, "embedding": 128}.items()
+}
+
+# Searches the UI runs at once, they wait on upstreams without holding a thread
+concurrency_limit = int(config.get("CONCURRENCY_LIMIT") or 64)
 
 
 ################################################################################
@@ -49,58 +175,64 @@ def extract_doi(text:str):
 
 ################################################################################
 # Function to search crossref by DOI
-@backoff.on_exception(
-    wait_gen=backoff.expo,
-    exception=requests.exceptions.RequestException,
-    jitter=backoff.full_jitter,
-    max_tries=3
-)
 def search_doi(doi: str):
-    
-    # URL encode the doi
-    doi = quote_plus(doi)
 
-    # Define the endpoint
-    crossref_api_url = f"https://api.crossref.org/works/{doi}"
+    # Served from the abstract cache when possible, concurrent lookups of the
+    # same DOI share one upstream call
+    return crossref_client.get_abstract(doi)
 
-    response = requests.get(crossref_api_url)
 
-    response_json = response.json()
 
-    return response_json.get("message").get('abstract')
+################################################################################
+# Function to embed text
+def embed(text: str) -> np.ndarray | bytes:
 
+    # Serve from the cache when this query has been embedded before
+    embedding = embedding_cache.get(text)
+    if embedding is not None:
+        return embedding
 
+    # Generate the 1024 bit binary embedding, batched with concurrent misses
+    embedding = binary_batcher.embed(normalize_text(text))
 
-################################################################################
-# Function to convert dense vector to binary vector
-def dense_to_binary(dense_vector: np.ndarray) -> bytes:
-    return np.packbits(np.where(dense_vector >= 0, 1, 0)).tobytes()
+    # Remember it for next time
+    embedding_cache.put(text, embedding)
 
+    return embedding
 
-# Function to embed text
-@cache
-def embed(text: str) -> np.ndarray | bytes:
 
-    # Call the MixedBread.ai API to generate the embedding
-    result = mxbai.embed(
-            model="mixedbread-ai/mxbai-embed-large-v1",
-            input=text,
-            normalized=True,
-            encoding_format="ubinary",
-            dimensions=1024,
-            )
+# Function to get the float embedding of text, used for rescoring
+def embed_float(text: str) -> np.ndarray:
+
+    # Serve from the cache when this query has been embedded before
+    embedding = float_embedding_cache.get(text)
+    if embedding is not None:
+        return np.frombuffer(embedding, dtype=np.float32)
 
-    # Convert the embedding to a numpy array of uint8 encoding and then to bytes
-    embedding = np.array(result.data[0].embedding, dtype=np.uint8).tobytes()
+    embedding = float_batcher.embed(normalize_text(text))
+
+    # Remember it for next time
+    float_embedding_cache.put(text, embedding.tobytes())
 
     return embedding
 
 
+# Function to get the vectors to search with: binary, and float when rescoring
+def embed_query(text: str) -> tuple[bytes, np.ndarray | None]:
+    if rescorer is None:
+        return embed(text), None
+
+    # Binarise the float embedding ourselves, saves a second API call
+    query_float = embed_float(text)
+    return dense_to_binary(query_float), query_float
+
+
 ################################################################################
 # Single vector search
 
 
-def search(vector: np.ndarray, limit: int, filter: str = "") -> list[dict]:
+# Function to convert the date filter of the UI to a filter expression
+def build_filter(filter: str = "") -> str:
     # Logic for converting the filter to a valid format
     if filter == "This Year":
         filter = f"year == {int(current_year)}"
@@ -111,42 +243,149 @@ def search(vector: np.ndarray, limit: int, filter: str = "") -> list[dict]:
     elif filter == "All":
         filter = ""
 
-    result = milvus_client.search(
-        collection_name="crossref",  # Collection to search in
-        data=[vector],  # Vector to search for
-        limit=limit,  # Max. number of search results to return
-        output_fields=[
-            "DOI",
-            "vector",
-            "title",
-            "abstract",
-            "author",
-            "month",
-            "year",
-            "URL",
-        ],  # Output fields to return
-        filter=filter,  # Filter to apply to the search
-    )
+    # Normalize whitespace so equivalent expressions share a cache entry
+    return " ".join(filter.split())
+
+
+# Function to search by Hamming distance, served from the cache when possible
+def search_binary(vector: bytes, limit: int, filter: str, offset: int = 0) -> list[dict]:
+
+    # Serve from the result cache when this window of this search is known
+    cached = search_cache.get(vector, filter, limit, offset)
+    if cached is not None:
+        return cached
+
+    # Only ask for what ranking needs, details are fetched per page
+    output_fields = ["year", "row_id"] if rescorer is not None else ["year"]
+    result = search_backend.search(vector, limit, filter, offset=offset, output_fields=output_fields)
+
+    # Remember the results
+    search_cache.put(vector, filter, limit, offset, result)
 
     # returns a list of dictionaries with id and distance as keys
-    return result[0]
+    return result
+
+
+def search(
+    vector: np.ndarray, limit: int, filter: str = "", offset: int = 0, query_float: np.ndarray | None = None
+) -> list[dict]:
+    filter = build_filter(filter)
+
+    # Plain Hamming search
+    if rescorer is None or query_float is None:
+        return search_binary(vector, limit, filter, offset)
+
+    # Over-fetch candidates by Hamming distance and rerank them by float
+    # similarity once, later pages are read from the same reranked list
+    key = (query_float.tobytes(), filter)
+    entry = reranked_cache.get(key)
+    if entry is None or entry[0] != search_cache.generation:
+        entry = (search_cache.generation, 0, False, [])
+    _, window, exhausted, reranked = entry
+
+    # Only when the list runs out, fetch a larger window and append its new
+    # candidates reranked among themselves, the order already paged through stays
+    while offset + limit > len(reranked) and not exhausted and window < MAX_SEARCH_WINDOW:
+        larger = min(max(window * 2, (offset + limit) * rescore_factor), MAX_SEARCH_WINDOW)
+        candidates = search_binary(vector, larger, filter)
+
+        # A short read means there are no more candidates
+        exhausted = len(candidates) < larger
+
+        known = {candidate["id"] for candidate in reranked}
+        candidates = [candidate for candidate in candidates[window:] if candidate["id"] not in known]
+
+        order = rescorer.rerank(query_float, [candidate["entity"]["row_id"] for candidate in candidates])
+        reranked = reranked + [candidates[index] for index in order]
+        window = larger
+
+        reranked_cache.put(key, (search_cache.generation, window, exhausted, reranked))
+
+    return reranked[offset : offset + limit]
 
 
 ################################################################################
+# Fields shown on a result card
+detail_fields = ["DOI", "title", "abstract", "author", "month", "year", "URL"]
+
+
+# Function to fetch the display fields of a page of papers in one call
+def fetch_details(dois: list[str]) -> dict[str, dict]:
+    details = {}
+    missing = []
+
+    # Serve popular papers from the hot document cache
+    for doi in dois:
+        paper_details = document_cache.get(doi)
+        if paper_details is None:
+            missing.append(doi)
+        else:
+            details[doi] = paper_details
+
+    # Fetch the rest with a single batched call
+    if missing:
+        rows = search_backend.get(ids=missing, output_fields=detail_fields)
+
+        for row in rows:
+            document_cache.put(row["DOI"], row)
+            details[row["DOI"]] = row
+
+    return details
+
+
 # Function to fetch paper details of all results
-def fetch_all_details(search_results: list[dict]) -> str:
+# With shown_abstracts, papers whose abstract was shown on an earlier page are skipped
+def fetch_all_details(search_results: list[dict], shown_abstracts: set | None = None) -> str:
     # Initialize an empty string to store the cards
     cards = ""
 
+    # Fetch the details of this page only
+    details = fetch_details([search_result["id"] for search_result in search_results])
+
+    # Papers to show, each with the papers sharing its abstract
+    papers = []
+    groups = {}
+
     for search_result in search_results:
-        paper_details = search_result["entity"]
+        paper_details = details.get(search_result["id"])
+
+        # Skip papers removed since the search was made
+        if paper_details is None:
+            continue
+
+        if not group_duplicates:
+            papers.append((paper_details, []))
+            continue
+
+        # Group under the best ranked paper with the same abstract
+        key = abstract_hash(paper_details["abstract"])
+
+        if shown_abstracts is not None and key in shown_abstracts:
+            continue
+
+        if key in groups:
+            groups[key][1].append(paper_details)
+        else:
+            groups[key] = (paper_details, [])
+            papers.append(groups[key])
+
+    if shown_abstracts is not None:
+        shown_abstracts.update(groups)
+
+    for paper_details, duplicates in papers:
+
+        # Other DOIs with the same abstract
+        also = ""
+        if duplicates:
+            links = ", ".join(f"[{duplicate['DOI']}]({duplicate['URL']})" for duplicate in duplicates)
+            also = f"> _Same abstract:_ {links} \n"
 
         # chr(10) is a new line character, replace to avoid formatting issues
         card = f"""
 ## [{paper_details["title"]}]({paper_details["URL"]})
 > **{paper_details["author"]}** | _{paper_details["month"]} {paper_details["year"]}_ \n
 {paper_details["abstract"]} \n
-***
+{also}***
 """
 
         cards += card
@@ -157,58 +396,98 @@ def fetch_all_details(search_results: list[dict]) -> str:
 ################################################################################
 
 
+# Function to look a DOI up in the database
+def lookup_doi(doi: str) -> list[dict]:
+    return search_backend.get(ids=[doi], output_fields=["vector", "row_id"] if rescorer else ["vector"])
+
+
+# Function to get the vectors to search with for a paper already in the database
+def stored_vectors(row: dict) -> tuple[bytes, np.ndarray | None]:
+    # The stored float embedding serves as the rescoring query
+    query_float = rescorer.embeddings([row["row_id"]])[0] if rescorer else None
+
+    # Get the bytes of a binary vector, no external calls needed
+    return row["vector"][0], query_float
+
+
+# Async search path, every upstream behind its own concurrency limit
+search_pipeline = SearchPipeline(
+    extract_doi=extract_doi,
+    lookup=lookup_doi,
+    stored_vectors=stored_vectors,
+    fetch_abstract=search_doi,
+    embed_query=embed_query,
+    search=search,
+    render=fetch_all_details,
+    deadline=request_deadline,
+    timeouts=stage_timeouts,
+    concurrency=upstream_concurrency,
+)
+
+
 # Function to handle the UI logic
-def predict(
+async def predict(
     input_text: str, limit: int = 5, increment: int = 5, filter: str = ""
-) -> tuple[str, gr.update, int]:
+) -> tuple[str, gr.update, gr.update, ResultCursor]:
     # Check if input is empty
     if input_text == "":
         raise gr.Error("Please provide either a DOI or an abstract.", 10)
 
     # Define extra outputs to pass
-    # This hack shows the load_more button once the search has been made
-    show_load_more = gr.update(visible=True)
+    # This hack shows the date filter once the search has been made
     show_date_filter = gr.update(visible=True)
 
-    # This variable is used to increment the search limit when the load_more button is clicked
-    new_limit = limit + increment
+    # Record which path the query takes and how long each stage lasts
+    trace = RequestTrace()
 
-    # Extract doi, if any
-    doi = extract_doi(input_text)
+    # Lookup, embed, search and render, within the request deadline
+    try:
+        all_details, cursor = await search_pipeline.run(input_text, limit, increment, filter, trace)
+    except AbstractNotFound as e:
+        trace_summary.record(trace.finish())
+        trace.report()
+        raise gr.Error(str(e), 10)
+    except StageTimeout as e:
+        trace_summary.record(trace.finish())
+        trace.report()
+        print(f"Pipeline: {e}, {search_pipeline.stats()}")
+        raise gr.Error("The search took too long, please try again.", 10)
 
-    # When doi is found in input text
-    if doi:
-        # Search if doi is already in database
-        id_in_db = milvus_client.get(collection_name="crossref", ids=[doi])
-        
-        # If the doi is already in database
-        if bool(id_in_db):
-            # Get the bytes of a binary vector
-            abstract_vector = id_in_db[0]["vector"][0]
+    # Report the trace
+    trace_summary.record(trace.finish())
+    trace.report()
 
-        # If the doi is not already in database
-        else:
-            # Search crossref for paper details
-            abstract = search_doi(doi)
-            
-            # If crossref returns an abstract
-            if abstract:
-                # Embed abstract
-                abstract_vector = embed(abstract)
-            else:
-                raise gr.Error(f"Crossref did not return any abstract for doi: {doi}", 10)
+    # Show the load_more button only while there is something left to show
+    show_load_more = gr.update(visible=cursor.has_more)
+
+    return all_details, show_load_more, show_date_filter, cursor
+
+
+# Function to show the next page of results of the current search
+async def load_more(cursor: ResultCursor | None, shown_details: str) -> tuple[str, gr.update, ResultCursor]:
+    # The cursor lives in the session, it is gone if the session expired
+    if cursor is None:
+        raise gr.Error("Please search again to see more results.", 10)
 
-    # When arxiv id is not found in input text, treat input text as abstract
-    # Embed abstract
-    abstract_vector = embed(input_text)
+    trace = RequestTrace(name="load_more")
+    trace.path = "cursor"
 
-    # Search database
-    search_results = search(abstract_vector, limit, filter)
+    # Fetch and render only the next page, and append it to what is already shown
+    try:
+        all_details = shown_details + await search_pipeline.next_page(cursor, trace)
+    except StageTimeout as e:
+        trace_summary.record(trace.finish())
+        trace.report()
+        print(f"Pipeline: {e}, {search_pipeline.stats()}")
+        raise gr.Error("Loading more results took too long, please try again.", 10)
 
-    # Gather details about the found papers
-    all_details = fetch_all_details(search_results)
+    # Report the trace
+    trace_summary.record(trace.finish())
+    trace.report()
 
-    return all_details, show_load_more, show_date_filter, new_limit
+    show_load_more = gr.update(visible=cursor.has_more)
+
+    return all_details, show_load_more, cursor
 
 
 ################################################################################
@@ -226,7 +505,7 @@ examples = ["2401.07215", "Smart TV and privacy"]
 
 # Show total number of entries in database
 num_entries = format(
-    milvus_client.get_collection_stats(collection_name="crossref")["row_count"],
+    search_backend.row_count(),
     ",",
 )
 
@@ -331,8 +610,8 @@ with gr.Blocks(
     # Define the increment for the "Load More" button
     increment = gr.State(5)
 
-    # Define new page limit
-    new_page_limit = gr.State(page_limit.value + increment.value)
+    # Cursor over the results of the current search, one per session
+    cursor = gr.State(None)
 
     # Output section, displays the search results
     output = gr.Markdown(
@@ -348,7 +627,7 @@ with gr.Blocks(
     input_text.submit(
         predict,
         [input_text, page_limit, increment, date_filter],
-        [output, load_more_button, date_filter, new_page_limit],
+        [output, load_more_button, date_filter, cursor],
         api_name="search",
     )
 
@@ -356,15 +635,16 @@ with gr.Blocks(
     date_filter.change(
         predict,
         [input_text, page_limit, increment, date_filter],
-        [output, load_more_button, date_filter, new_page_limit],
+        [output, load_more_button, date_filter, cursor],
         api_name=False,
     )
 
     # Event handler for the "Load More" button
+    # Appends the next page from the cursor instead of searching again
     load_more_button.click(
-        predict,
-        [input_text, new_page_limit, increment, date_filter],
-        [output, load_more_button, date_filter, new_page_limit],
+        load_more,
+        [cursor, output],
+        [output, load_more_button, cursor],
         api_name=False,
     )
 
@@ -372,7 +652,7 @@ with gr.Blocks(
     gr.Examples(
         examples=examples,
         inputs=input_text,
-        outputs=[output, load_more_button, date_filter, new_page_limit],
+        outputs=[output, load_more_button, date_filter, cursor],
         fn=predict,
         label="Try:",
         run_on_click=True,
@@ -402,5 +682,11 @@ with demo.route("About", "/about"):
 ################################################################################
 
 if __name__ == "__main__":
-    
+
+    # Log the latency per path and the cache statistics in the background
+    stats_reporter.start()
+
+    # Without a limit Gradio runs one search at a time per event
+    demo.queue(default_concurrency_limit=concurrency_limit)
+
     demo.launch(server_port=7870, favicon_path="logo.png", show_api=False, pwa=True)
\ No newline at end of file
@@ -0,0 +1,82 @@
+# Import required libraries
+import numpy as np
+
+################################################################################
+# Length bucketed batching for embedding abstracts
+# Abstracts vary a lot in length, and every batch is padded to its longest
+# abstract. Rows are grouped into buckets of similar token length and each
+# bucket is encoded with as many rows per batch as fit a token budget, so short
+# abstracts go through in large batches and long ones in small batches.
+# Embeddings are returned in the original row order.
+
+
+# Function to count the tokens of every text, as the model will see them
+def token_lengths(model, texts: list[str]) -> np.ndarray:
+    if not texts:
+        return np.empty(0, dtype=np.int64)
+
+    input_ids = model.tokenizer(
+        texts,
+        add_special_tokens=True,
+        truncation=True,
+        max_length=model.max_seq_length,
+    )["input_ids"]
+
+    return np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(texts))
+
+
+# Function to group rows into buckets of similar length, each with the batch size that fits the budget
+# Every bucket holds rows whose length rounds up to the same multiple of
+# bucket_width, so a batch of batch_size rows never pads past max_tokens.
+def length_buckets(
+    lengths: np.ndarray, max_tokens: int, bucket_width: int = 32, max_batch_size: int | None = None
+) -> list[tuple[np.ndarray, int]]:
+    padded = -(-np.maximum(lengths, 1) // bucket_width) * bucket_width
+
+    buckets = []
+    for padded_length in np.unique(padded):
+        indices = np.flatnonzero(padded == padded_length)
+
+        batch_size = max(1, max_tokens // int(padded_length))
+        if max_batch_size is not None:
+            batch_size = min(batch_size, max_batch_size)
+
+        buckets.append((indices, batch_size))
+
+    return buckets
+
+
+# Function to compute how many tokens a list of batches pads to, over the real token count
+def padding_ratio(lengths: np.ndarray, batches: list[np.ndarray]) -> float:
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches if len(batch))
+    return padded / max(int(lengths.sum()), 1)
+
+
+# Function to split buckets into the batches the model will actually run
+def bucket_batches(buckets: list[tuple[np.ndarray, int]]) -> list[np.ndarray]:
+    return [
+        indices[start : start + batch_size]
+        for indices, batch_size in buckets
+        for start in range(0, len(indices), batch_size)
+    ]
+
+
+################################################################################
+# Function to embed texts bucket by bucket under a token budget, returned in input order
+# Extra keyword arguments go to model.encode, e.g. pool= for multiple GPUs.
+def encode_bucketed(
+    model, texts: list[str], max_tokens: int, bucket_width: int = 32, max_batch_size: int | None = None, **encode_kwargs
+) -> np.ndarray:
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    lengths = token_lengths(model, texts)
+
+    for indices, batch_size in length_buckets(lengths, max_tokens, bucket_width, max_batch_size):
+        embeddings[indices] = model.encode(
+            [texts[index] for index in indices],
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            **encode_kwargs,
+        )
+
+    return embeddings
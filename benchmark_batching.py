@@ -0,0 +1,110 @@
+# Import required libraries
+import argparse
+import json
+from glob import glob
+from time import perf_counter
+
+import numpy as np
+import pyarrow.parquet as pq
+from sentence_transformers import SentenceTransformer
+
+from batching import bucket_batches, encode_bucketed, length_buckets, padding_ratio, token_lengths
+
+################################################################################
+# Benchmark of length bucketed batching on CPU
+# Embeds a sample of abstracts three ways and reports rows per second and how
+# many tokens every strategy pads to, relative to the real token count:
+#   dataset_order: fixed size batches in dataset order, as dataset.map fed them
+#   length_sorted: one encode call, which sorts by length inside a fixed batch size
+#   token_budget:  length buckets under a token budget (batching.encode_bucketed)
+
+
+# Function to read the first abstracts of the metadata shards
+def load_sample(files: list[str], num_rows: int) -> list[str]:
+    abstracts = []
+
+    for file in files:
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=num_rows, columns=["abstract"]):
+            abstracts.extend(batch.column("abstract").to_pylist())
+            if len(abstracts) >= num_rows:
+                return abstracts[:num_rows]
+
+    return abstracts
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark length bucketed batching on CPU")
+    parser.add_argument("--metadata-folder", default="crossref_metadata_split")
+    parser.add_argument("--model", default="mixedbread-ai/mxbai-embed-large-v1")
+    parser.add_argument("--rows", type=int, default=1_000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=0, help="Defaults to batch size x max sequence length")
+    parser.add_argument("--output", default="bench_batching.json")
+    args = parser.parse_args()
+
+    files = glob(f"{args.metadata_folder}/**/*.parquet", recursive=True)
+    files.sort()
+
+    texts = load_sample(files, args.rows)
+    model = SentenceTransformer(args.model, device="cpu")
+    max_tokens = args.max_tokens or args.batch_size * model.max_seq_length
+
+    lengths = token_lengths(model, texts)
+    print(f"{len(texts)} abstracts, {lengths.mean():.0f} tokens on average, {lengths.max()} at most")
+
+    # Warm up
+    model.encode(texts[: args.batch_size], batch_size=args.batch_size)
+
+    results = []
+
+    # Fixed size batches in dataset order
+    start = perf_counter()
+    reference = np.concatenate(
+        [
+            model.encode(texts[offset : offset + args.batch_size], batch_size=args.batch_size, convert_to_numpy=True)
+            for offset in range(0, len(texts), args.batch_size)
+        ]
+    )
+    seconds = perf_counter() - start
+    batches = [np.arange(offset, min(offset + args.batch_size, len(texts))) for offset in range(0, len(texts), args.batch_size)]
+    results.append({"strategy": "dataset_order", "seconds": seconds, "padding_ratio": padding_ratio(lengths, batches)})
+
+    # One call, sorted by length inside sentence-transformers
+    start = perf_counter()
+    model.encode(texts, batch_size=args.batch_size, convert_to_numpy=True)
+    seconds = perf_counter() - start
+    order = np.argsort(-lengths, kind="stable")
+    batches = [order[offset : offset + args.batch_size] for offset in range(0, len(texts), args.batch_size)]
+    results.append({"strategy": "length_sorted", "seconds": seconds, "padding_ratio": padding_ratio(lengths, batches)})
+
+    # Length buckets under a token budget
+    start = perf_counter()
+    bucketed = encode_bucketed(model, texts, max_tokens)
+    seconds = perf_counter() - start
+    batches = bucket_batches(length_buckets(lengths, max_tokens))
+    results.append({"strategy": "token_budget", "seconds": seconds, "padding_ratio": padding_ratio(lengths, batches)})
+
+    # The order must be restored, so every row gets back its own embedding
+    similarity = np.sum(reference * bucketed, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(bucketed, axis=1)
+    )
+    print(f"Lowest cosine similarity to the dataset order embeddings: {similarity.min():.6f}")
+
+    for result in results:
+        result.update(
+            rows=len(texts),
+            batch_size=args.batch_size,
+            max_tokens=max_tokens,
+            rows_per_second=round(len(texts) / result["seconds"], 2),
+            seconds=round(result["seconds"], 3),
+            padding_ratio=round(result["padding_ratio"], 3),
+        )
+        print(result)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"Results written to {args.output}")
@@ -0,0 +1,72 @@
+# Import required libraries
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+import pyarrow as pa
+
+from vectors import VECTOR_DIMENSIONS, binarise_vectors
+
+################################################################################
+# Benchmark of binarising float embeddings
+# Compares the row by row binarisation the embedding scripts used to run
+# through dataset.map, including turning each Arrow row into a Python list,
+# against binarising whole Arrow batches at once. Reports rows per second.
+
+
+# Function to binarise one row, as previously done in embed_multigpu*.py
+def binarise_row(vector: list[float]) -> bytes:
+    float_vector = np.array(vector, dtype=np.float32)
+    binary_vector = np.where(float_vector >= 0, 1, 0)
+    return np.packbits(binary_vector).tobytes()
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark row by row against batched binarisation")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--output", default="bench_binarise.json")
+    args = parser.parse_args()
+
+    # Random embeddings, stored the way datasets stores model.encode output
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((args.rows, VECTOR_DIMENSIONS), dtype=np.float32)
+    column = pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel()), VECTOR_DIMENSIONS).cast(
+        pa.list_(pa.float32())
+    )
+    print(f"{args.rows} vectors of {VECTOR_DIMENSIONS} dimensions")
+
+    # Row by row
+    start = perf_counter()
+    row_by_row = [binarise_row(vector) for vector in column.to_pylist()]
+    row_seconds = perf_counter() - start
+
+    # Batched
+    start = perf_counter()
+    batched = [
+        binarise_vectors(column.slice(offset, args.batch_size), pa.binary())
+        for offset in range(0, args.rows, args.batch_size)
+    ]
+    batched_seconds = perf_counter() - start
+
+    # Both must give the same bytes
+    if pa.chunked_array(batched).to_pylist() != row_by_row:
+        raise ValueError("Batched binarisation does not match the row by row result")
+
+    results = {
+        "rows": args.rows,
+        "batch_size": args.batch_size,
+        "row_by_row_rows_per_second": round(args.rows / row_seconds, 1),
+        "batched_rows_per_second": round(args.rows / batched_seconds, 1),
+        "speedup": round(row_seconds / batched_seconds, 1),
+    }
+    print(results)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"Results written to {args.output}")
@@ -0,0 +1,98 @@
+# Import required libraries
+import argparse
+import json
+from glob import glob
+from time import perf_counter
+
+import numpy as np
+
+from benchmark_batching import load_sample
+from embedding_backend import load_model, model_name, quantized_onnx_file
+from vectors import hamming_distances
+
+################################################################################
+# Benchmark of the local CPU embedding backend
+# Embeds a sample of abstracts with the float PyTorch model and with the int8
+# quantized ONNX model, both on the CPU, and reports throughput together with
+# how well the ONNX binary vectors agree with the float model's: the share of
+# equal bits, and the overlap of the top k neighbours by Hamming distance.
+
+
+# Function to embed texts and time it
+def embed(model, texts: list[str], batch_size: int) -> tuple[np.ndarray, float]:
+    start = perf_counter()
+    embeddings = model.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+    return embeddings.astype(np.float32), perf_counter() - start
+
+
+# Function to find the k nearest rows of every row by Hamming distance, itself excluded
+def neighbours(binary: np.ndarray, k: int) -> list[set[int]]:
+    found = []
+    for row, query in enumerate(binary):
+        distances = hamming_distances(binary, query)
+        distances[row] = np.iinfo(distances.dtype).max
+        found.append(set(np.argsort(distances, kind="stable")[:k].tolist()))
+    return found
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ONNX int8 CPU embedding backend")
+    parser.add_argument("--metadata-folder", default="crossref_metadata_split")
+    parser.add_argument("--onnx-file", default=quantized_onnx_file)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--rows", type=int, default=1_000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", default="bench_embedding_backend.json")
+    args = parser.parse_args()
+
+    files = glob(f"{args.metadata_folder}/**/*.parquet", recursive=True)
+    files.sort()
+
+    texts = load_sample(files, args.rows)
+    print(f"{len(texts)} abstracts")
+
+    results = []
+    embeddings = {}
+
+    for name, onnx_file in [("torch_float", None), ("onnx_int8", args.onnx_file)]:
+        model = load_model(model_name, onnx_file=onnx_file, threads=args.threads)
+
+        # Warm up
+        embed(model, texts[: args.batch_size], args.batch_size)
+
+        embeddings[name], seconds = embed(model, texts, args.batch_size)
+        results.append({"backend": name, "rows": len(texts), "seconds": round(seconds, 3), "rows_per_second": round(len(texts) / seconds, 2)})
+        print(results[-1])
+
+        # Single query latency, as the app embeds one query at a time
+        latencies = []
+        for text in texts[:100]:
+            start = perf_counter()
+            model.encode([text], normalize_embeddings=True, convert_to_numpy=True)
+            latencies.append(perf_counter() - start)
+        results[-1]["query_p50_ms"] = round(float(np.percentile(latencies, 50)) * 1000, 3)
+        results[-1]["query_p95_ms"] = round(float(np.percentile(latencies, 95)) * 1000, 3)
+
+    # Agreement of the binary vectors, thresholded at zero as in the collection
+    reference = np.packbits(embeddings["torch_float"] >= 0, axis=1)
+    candidate = np.packbits(embeddings["onnx_int8"] >= 0, axis=1)
+
+    differing_bits = np.array([hamming_distances(reference[row : row + 1], candidate[row])[0] for row in range(len(reference))])
+    expected, found = neighbours(reference, args.k), neighbours(candidate, args.k)
+
+    agreement = {
+        "bit_agreement_mean": round(1 - float(differing_bits.mean()) / 1024, 4),
+        "bit_agreement_min": round(1 - float(differing_bits.max()) / 1024, 4),
+        f"neighbour_overlap@{args.k}": round(float(np.mean([len(a & b) / args.k for a, b in zip(expected, found)])), 4),
+        "cosine_mean": round(float(np.mean(np.sum(embeddings["torch_float"] * embeddings["onnx_int8"], axis=1))), 4),
+    }
+    print(agreement)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump({"backends": results, "agreement": agreement}, file, indent=2)
+
+    print(f"Results written to {args.output}")
@@ -0,0 +1,113 @@
+# Import required libraries
+import argparse
+import json
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+from vectors import VECTOR_BYTES
+
+################################################################################
+# Benchmark of filtered search latency
+#
+# Local backend: compares the year sorted layout (only the matching slice is
+# scanned) against a full scan with the year checked afterwards.
+# Milvus backend: run once before and once after clustering compaction with a
+# different --label, and compare the two sets of results.
+
+# Same filters as the app
+current_year = datetime.now().year
+filters = {
+    "All": "",
+    "This Year": f"year == {current_year}",
+    "Last 5 Years": f"year >= {current_year - 5}",
+    "Last 10 Years": f"year >= {current_year - 10}",
+}
+
+
+# Function to time a search function over a set of queries
+def time_searches(search_fn, queries: list[bytes], limit: int) -> dict:
+    latencies = []
+
+    for query in queries:
+        start = perf_counter()
+        search_fn(query, limit)
+        latencies.append(perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+
+    return {
+        "queries": len(queries),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+    }
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark filtered search latency")
+    parser.add_argument("--backend", choices=["local", "milvus"], default="local")
+    parser.add_argument("--index-dir", default="local_index")
+    parser.add_argument("--milvus-uri", default="http://localhost:19530")
+    parser.add_argument("--label", default="", help="Free text stored with the results, e.g. before-compaction")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--output", default="bench_filters.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = []
+
+    if args.backend == "local":
+        from local_search import LocalSearch, parse_year_filter
+
+        engine = LocalSearch(args.index_dir)
+
+        # Use indexed vectors as queries
+        rows = rng.choice(engine.row_count(), size=min(args.queries, engine.row_count()), replace=False)
+        queries = [engine.vectors[row].tobytes() for row in rows]
+
+        for name, expression in filters.items():
+            for mode, prune in [("full_scan", False), ("year_sorted", True)]:
+                timing = time_searches(
+                    lambda query, limit: engine.search(query, limit, expression, prune=prune), queries, args.limit
+                )
+                start, stop = engine.year_slice(*parse_year_filter(expression))
+                result = {
+                    "backend": "local",
+                    "label": args.label,
+                    "filter": name,
+                    "mode": mode,
+                    "rows_matching": stop - start,
+                    **timing,
+                }
+                results.append(result)
+                print(result)
+
+    else:
+        from search_backend import MilvusBackend
+
+        backend = MilvusBackend(args.milvus_uri)
+
+        # Latency does not depend on the query, random vectors will do
+        queries = [rng.integers(0, 256, VECTOR_BYTES, dtype=np.uint8).tobytes() for _ in range(args.queries)]
+
+        # Warm up
+        backend.search(queries[0], args.limit)
+
+        for name, expression in filters.items():
+            timing = time_searches(
+                lambda query, limit: backend.search(query, limit, expression), queries, args.limit
+            )
+            result = {"backend": "milvus", "label": args.label, "filter": name, **timing}
+            results.append(result)
+            print(result)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"Results written to {args.output}")
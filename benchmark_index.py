@@ -0,0 +1,230 @@
+# Import required libraries
+import argparse
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from time import perf_counter, sleep
+
+import numpy as np
+import pyarrow.parquet as pq
+import requests
+from pymilvus import DataType, MilvusClient
+
+from vectors import binary_vectors_to_matrix, hamming_distances
+
+################################################################################
+# Index parameter sweep for the binary vector collection
+# Loads a sample of the processed shards into a scratch collection, then for
+# every index type / build parameter / search parameter combination reports
+# build time, memory, QPS, latency percentiles and recall against exact Hamming
+# ground truth. Results go to a JSON file, one record per combination.
+
+# Scratch collection, so the serving collection is never touched
+collection_name = "crossref_index_bench"
+
+# Index types and build parameters to try
+index_grid = [
+    ("BIN_FLAT", {}),
+    ("BIN_IVF_FLAT", {"nlist": 128}),
+    ("BIN_IVF_FLAT", {"nlist": 1024}),
+    ("BIN_IVF_FLAT", {"nlist": 4096}),
+    ("BIN_IVF_FLAT", {"nlist": 16384}),
+]
+
+# Query time nprobe values to try with IVF indexes
+nprobe_grid = [1, 8, 16, 32, 64, 128, 256]
+
+
+################################################################################
+# Function to read a sample of ids and vectors from the processed shards
+def load_sample(files: list[str], num_rows: int) -> tuple[list[str], np.ndarray]:
+    dois = []
+    matrices = []
+    remaining = num_rows
+
+    for file in files:
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=min(remaining, 50_000), columns=["DOI", "vector"]):
+            dois.extend(batch.column("DOI").to_pylist())
+            matrices.append(binary_vectors_to_matrix(batch.column("vector")).copy())
+            remaining -= batch.num_rows
+            if remaining <= 0:
+                return dois[:num_rows], np.concatenate(matrices)[:num_rows]
+
+    return dois, np.concatenate(matrices)
+
+
+# Function to read the resident memory of the Milvus process from its metrics
+def milvus_memory_bytes(metrics_url: str) -> int | None:
+    try:
+        metrics = requests.get(metrics_url, timeout=5).text
+    except requests.exceptions.RequestException:
+        return None
+
+    match = re.search(r"^process_resident_memory_bytes\s+(\S+)$", metrics, re.MULTILINE)
+    return int(float(match.group(1))) if match else None
+
+
+# Function to create the scratch collection and insert the corpus
+def create_collection(client: MilvusClient, dois: list[str], matrix: np.ndarray, batch_size: int = 10_000):
+    client.drop_collection(collection_name=collection_name)
+
+    schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=False)
+    schema.add_field(field_name="DOI", datatype=DataType.VARCHAR, max_length=256, is_primary=True)
+    schema.add_field(field_name="vector", datatype=DataType.BINARY_VECTOR, dim=1024)
+
+    client.create_collection(collection_name=collection_name, schema=schema)
+
+    for start in range(0, len(dois), batch_size):
+        client.insert(
+            collection_name=collection_name,
+            data=[
+                {"DOI": doi, "vector": vector.tobytes()}
+                for doi, vector in zip(dois[start : start + batch_size], matrix[start : start + batch_size])
+            ],
+        )
+
+    client.flush(collection_name=collection_name)
+
+
+# Function to run the queries and measure latency, throughput and recall
+def run_queries(client, queries, truth, k, search_params, concurrency) -> dict:
+
+    def search_one(query):
+        start = perf_counter()
+        result = client.search(
+            collection_name=collection_name,
+            data=[query.tobytes()],
+            limit=k,
+            search_params={"metric_type": "HAMMING", "params": search_params},
+        )
+        return perf_counter() - start, [hit["id"] for hit in result[0]]
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        outcomes = list(executor.map(search_one, queries))
+    wall_time = perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in outcomes]) * 1000
+
+    # Recall against the exact top k, counting ties at the k-th distance as hits
+    recalls = []
+    for (_, found), (expected, cutoff, distances) in zip(outcomes, truth):
+        hits = sum(1 for doi in found if doi in expected or distances.get(doi, cutoff + 1) <= cutoff)
+        recalls.append(min(hits, k) / k)
+
+    return {
+        "qps": round(len(queries) / wall_time, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+    }
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep index parameters of the binary collection")
+    parser.add_argument("--processed-folder", default="/mnt/block_volume/volumes/milvus/processed_data")
+    parser.add_argument("--milvus-uri", default="http://localhost:19530")
+    parser.add_argument("--metrics-url", default="http://localhost:9091/metrics")
+    parser.add_argument("--corpus-rows", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", default="bench_index.json")
+    args = parser.parse_args()
+
+    files = glob(f"{args.processed_folder}/*.parquet")
+    files.sort()
+
+    # Held out queries and the corpus
+    dois, matrix = load_sample(files, args.corpus_rows + args.queries)
+    queries, corpus, corpus_dois = matrix[: args.queries], matrix[args.queries :], dois[args.queries :]
+    print(f"Corpus of {len(corpus)} rows, {len(queries)} queries")
+
+    # Exact Hamming ground truth
+    print("Computing ground truth")
+    truth = []
+    for query in queries:
+        distances = hamming_distances(corpus, query)
+        top = np.argpartition(distances, args.k - 1)[: args.k]
+        cutoff = int(distances[top].max())
+        tied = np.nonzero(distances <= cutoff)[0]
+        truth.append(
+            (
+                {corpus_dois[row] for row in top},
+                cutoff,
+                {corpus_dois[row]: int(distances[row]) for row in tied},
+            )
+        )
+
+    client = MilvusClient(args.milvus_uri)
+
+    print(f"Inserting corpus into {collection_name}")
+    create_collection(client, corpus_dois, corpus)
+    baseline_memory = milvus_memory_bytes(args.metrics_url)
+
+    results = []
+    for index_type, build_params in index_grid:
+        print("*" * 80)
+        print(f"Index: {index_type} {build_params}")
+
+        # Replace the previous index
+        client.release_collection(collection_name=collection_name)
+        for index_name in client.list_indexes(collection_name=collection_name):
+            client.drop_index(collection_name=collection_name, index_name=index_name)
+
+        index_params = MilvusClient.prepare_index_params()
+        index_params.add_index(
+            field_name="vector",
+            metric_type="HAMMING",
+            index_type=index_type,
+            index_name="vector_index",
+            params=build_params,
+        )
+
+        start = perf_counter()
+        client.create_index(collection_name=collection_name, index_params=index_params, sync=True)
+        build_seconds = perf_counter() - start
+
+        start = perf_counter()
+        client.load_collection(collection_name=collection_name)
+        load_seconds = perf_counter() - start
+
+        # Give the metrics a moment to catch up
+        sleep(5)
+        memory = milvus_memory_bytes(args.metrics_url)
+
+        # Warm up
+        run_queries(client, queries[:10], truth[:10], args.k, {}, 1)
+
+        search_grid = [{"nprobe": nprobe} for nprobe in nprobe_grid if nprobe <= build_params.get("nlist", 0)] or [{}]
+
+        for search_params in search_grid:
+            measurements = run_queries(client, queries, truth, args.k, search_params, args.concurrency)
+
+            result = {
+                "index_type": index_type,
+                "build_params": build_params,
+                "search_params": search_params,
+                "corpus_rows": len(corpus),
+                "queries": len(queries),
+                "concurrency": args.concurrency,
+                "build_seconds": round(build_seconds, 3),
+                "load_seconds": round(load_seconds, 3),
+                "memory_bytes": memory,
+                "memory_over_baseline_bytes": memory - baseline_memory if memory and baseline_memory else None,
+                **measurements,
+            }
+            results.append(result)
+            print(result)
+
+            # Save after every combination, so a long sweep can be inspected as it runs
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+
+    client.drop_collection(collection_name=collection_name)
+
+    print(f"Results written to {args.output}")
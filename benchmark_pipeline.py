@@ -0,0 +1,288 @@
+# Import required libraries
+import argparse
+import asyncio
+import json
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import numpy as np
+
+from embed_batcher import EmbeddingBatcher
+from pipeline import AbstractNotFound, SearchPipeline, StageTimeout
+from request_trace import CROSSREF_EMBED, RAW_TEXT, RequestTrace
+from result_cursor import ResultCursor
+
+################################################################################
+# Load test of the search path with stubbed upstreams
+# Milvus, Crossref and the embedding API are replaced by blocking calls that
+# sleep for a set latency, and some Crossref calls hang for much longer, as a
+# slow upstream does. The same mix of searches, raw text and DOIs that are not
+# indexed, is run two ways at several numbers of concurrent users:
+#   threaded: the stages one after another on a fixed pool of worker threads,
+#             as the synchronous predict ran on Gradio's thread pool
+#   async:    pipeline.SearchPipeline, per-upstream limits, stage timeouts and
+#             a request deadline
+#   batched:  async, with concurrent embeddings micro-batched into one call
+#             (embed_batcher.EmbeddingBatcher), when --embed-batch-size is set
+# An embedding call costs a fixed round trip plus a little per text. Both async
+# runs make at most --embedding-concurrency embedding calls at once.
+# Reports throughput and latency per path, and how many searches timed out.
+
+
+class StubUpstreams:
+    def __init__(
+        self, milvus_ms: float, crossref_ms: float, embed_ms: float, embed_per_text_ms: float, slow_ms: float, slow_fraction: float, seed: int = 0
+    ):
+        self.milvus = milvus_ms / 1000
+        self.crossref = crossref_ms / 1000
+        self.embed = embed_ms / 1000
+        self.embed_per_text = embed_per_text_ms / 1000
+        self.slow = slow_ms / 1000
+        self.slow_fraction = slow_fraction
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def extract_doi(text: str) -> str | None:
+        return text if text.startswith("10.") else None
+
+    # None of the DOIs are indexed, so they all go through Crossref
+    def lookup(self, doi: str) -> list[dict]:
+        sleep(self.milvus)
+        return []
+
+    @staticmethod
+    def stored_vectors(row: dict) -> tuple[bytes, None]:
+        return row["vector"][0], None
+
+    def fetch_abstract(self, doi: str) -> str:
+        with self.lock:
+            slow = self.random.random() < self.slow_fraction
+        sleep(self.slow if slow else self.crossref)
+        return f"Abstract of {doi}"
+
+    def embed_binary_batch(self, texts: list[str]) -> list[bytes]:
+        sleep(self.embed + self.embed_per_text * len(texts))
+        return [bytes(128) for _ in texts]
+
+    def embed_query(self, text: str) -> tuple[bytes, None]:
+        return self.embed_binary_batch([text])[0], None
+
+    def search(self, vector: bytes, limit: int, filter: str = "", offset: int = 0, **kwargs) -> list[dict]:
+        sleep(self.milvus)
+        return [{"id": f"10.0/{offset + i}", "distance": i} for i in range(limit)]
+
+    def render(self, search_results: list[dict], shown_abstracts: set | None = None) -> str:
+        sleep(self.milvus)
+        return "".join(f"## {result['id']}\n" for result in search_results)
+
+
+# Function to search the way the synchronous predict did, one stage after another
+def predict_sync(stubs: StubUpstreams, input_text: str, trace: RequestTrace) -> str:
+    doi = stubs.extract_doi(input_text)
+
+    if doi:
+        trace.path = CROSSREF_EMBED
+        with trace.stage("lookup"):
+            stubs.lookup(doi)
+        with trace.stage("crossref"):
+            abstract = stubs.fetch_abstract(doi)
+        with trace.stage("embed"):
+            vector, query_float = stubs.embed_query(abstract)
+    else:
+        trace.path = RAW_TEXT
+        with trace.stage("embed"):
+            vector, query_float = stubs.embed_query(input_text)
+
+    cursor = ResultCursor(vector, "", page_size=5, query_float=query_float)
+    with trace.stage("search"):
+        search_results = cursor.next_page(stubs.search)
+    with trace.stage("render"):
+        return stubs.render(search_results, cursor.shown_abstracts)
+
+
+# Function to build the searches of a run, a share of them DOIs
+def make_queries(count: int, doi_fraction: float, seed: int = 0) -> list[str]:
+    generator = random.Random(seed)
+    return [f"10.1234/{i}" if generator.random() < doi_fraction else f"Query number {i}" for i in range(count)]
+
+
+# Function to summarize the outcome of every search of a run
+def summarize(outcomes: list[tuple[str, float, str]], seconds: float) -> dict:
+    summary = {
+        "requests": len(outcomes),
+        "seconds": round(seconds, 3),
+        "completed_per_second": round(sum(outcome == "ok" for _, _, outcome in outcomes) / seconds, 2),
+        "timeouts": sum(outcome == "timeout" for _, _, outcome in outcomes),
+        "paths": {},
+    }
+
+    for path in sorted({path for path, _, _ in outcomes}):
+        latencies = np.array([latency for p, latency, _ in outcomes if p == path]) * 1000
+        summary["paths"][path] = {
+            "count": len(latencies),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+            "max_ms": round(float(latencies.max()), 2),
+        }
+
+    return summary
+
+
+################################################################################
+
+
+# Function to run the searches on a fixed thread pool, users clients at a time
+def run_threaded(stubs: StubUpstreams, queries: list[str], users: int, workers: int) -> dict:
+    outcomes = []
+    pending = iter(queries)
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        # Every user sends its next search once the previous one is answered
+        def user():
+            while True:
+                with lock:
+                    query = next(pending, None)
+                if query is None:
+                    return
+
+                trace = RequestTrace()
+                start = perf_counter()
+                pool.submit(predict_sync, stubs, query, trace).result()
+
+                with lock:
+                    outcomes.append((trace.path, perf_counter() - start, "ok"))
+
+        start = perf_counter()
+        clients = [threading.Thread(target=user) for _ in range(users)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+    return summarize(outcomes, perf_counter() - start)
+
+
+# Function to run the searches through the async pipeline, users at a time
+async def run_async(stubs: StubUpstreams, queries: list[str], users: int, args, batched: bool = False) -> dict:
+    embedding_concurrency = args.embedding_concurrency
+
+    batcher = None
+    if not batched:
+        embed_query = stubs.embed_query
+    else:
+        # Calls in flight are bounded by the batcher, enough searches may wait on it to fill every batch
+        batcher = EmbeddingBatcher(
+            stubs.embed_binary_batch,
+            max_batch_size=args.embed_batch_size,
+            window_ms=args.embed_batch_window_ms,
+            max_in_flight=args.embedding_concurrency,
+        )
+        embedding_concurrency = args.embedding_concurrency * args.embed_batch_size
+
+        def embed_query(text):
+            return batcher.embed(text), None
+
+    pipeline = SearchPipeline(
+        extract_doi=stubs.extract_doi,
+        lookup=stubs.lookup,
+        stored_vectors=stubs.stored_vectors,
+        fetch_abstract=stubs.fetch_abstract,
+        embed_query=embed_query,
+        search=stubs.search,
+        render=stubs.render,
+        deadline=args.deadline,
+        timeouts={"crossref": args.crossref_timeout},
+        concurrency={"milvus": args.milvus_concurrency, "crossref": args.crossref_concurrency, "embedding": embedding_concurrency},
+    )
+
+    outcomes = []
+    pending = iter(queries)
+
+    async def user():
+        for query in pending:
+            trace = RequestTrace()
+            start = perf_counter()
+
+            try:
+                await pipeline.run(query, 5, 5, "", trace)
+                outcome = "ok"
+            except StageTimeout:
+                outcome = "timeout"
+            except AbstractNotFound:
+                outcome = "not_found"
+
+            outcomes.append((trace.path, perf_counter() - start, outcome))
+
+    start = perf_counter()
+    await asyncio.gather(*(user() for _ in range(users)))
+    seconds = perf_counter() - start
+
+    summary = summarize(outcomes, seconds)
+    summary["upstreams"] = pipeline.stats()
+    pipeline.close()
+
+    if batcher is not None:
+        summary["batches"] = batcher.stats()
+        batcher.close()
+
+    return summary
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the search path with stubbed upstreams")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--users", default="8,32,128", help="Concurrent users, comma separated")
+    parser.add_argument("--doi-fraction", type=float, default=0.3, help="Share of searches by a DOI that is not indexed")
+    parser.add_argument("--milvus-ms", type=float, default=10)
+    parser.add_argument("--crossref-ms", type=float, default=300)
+    parser.add_argument("--embed-ms", type=float, default=80, help="Round trip of an embedding call")
+    parser.add_argument("--embed-per-text-ms", type=float, default=2, help="Added per text in the call")
+    parser.add_argument("--embed-batch-size", type=int, default=0, help="Also run with micro-batched embeddings, 0 to skip")
+    parser.add_argument("--embed-batch-window-ms", type=float, default=5)
+    parser.add_argument("--slow-ms", type=float, default=8000, help="Latency of a hanging Crossref call")
+    parser.add_argument("--slow-fraction", type=float, default=0.1, help="Share of Crossref calls that hang")
+    parser.add_argument("--workers", type=int, default=40, help="Threads of the threaded run, Gradio's default")
+    parser.add_argument("--deadline", type=float, default=10)
+    parser.add_argument("--crossref-timeout", type=float, default=2)
+    parser.add_argument("--milvus-concurrency", type=int, default=32)
+    parser.add_argument("--crossref-concurrency", type=int, default=16)
+    parser.add_argument("--embedding-concurrency", type=int, default=32, help="Embedding calls at once, as the API allows")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    args = parser.parse_args()
+
+    queries = make_queries(args.requests, args.doi_fraction)
+
+    results = []
+    for users in [int(value) for value in args.users.split(",")]:
+        for mode in ["threaded", "async", "batched"] if args.embed_batch_size else ["threaded", "async"]:
+            # Same hanging calls for every run
+            stubs = StubUpstreams(args.milvus_ms, args.crossref_ms, args.embed_ms, args.embed_per_text_ms, args.slow_ms, args.slow_fraction)
+
+            if mode == "threaded":
+                summary = run_threaded(stubs, queries, users, args.workers)
+            else:
+                summary = asyncio.run(run_async(stubs, queries, users, args, batched=mode == "batched"))
+
+            summary.update({"mode": mode, "users": users})
+            results.append(summary)
+
+            raw_text = summary["paths"].get(RAW_TEXT, {})
+            print(
+                f"{mode:>8} {users:>4} users: {summary['completed_per_second']:>8.2f} searches/s, "
+                f"{summary['timeouts']} timeouts, raw text p95 {raw_text.get('p95_ms', 0):.0f} ms"
+            )
+            if "batches" in summary:
+                print(f"{'':>8} batches: {summary['batches']}")
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump({"args": vars(args), "results": results}, file, indent=2)
+
+    print(f"Results written to {args.output}")
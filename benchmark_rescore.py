@@ -0,0 +1,109 @@
+# Import required libraries
+import argparse
+import json
+from glob import glob
+from time import perf_counter
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from rescore import Rescorer, calibrate_ranges, normalize, quantize_int8
+from vectors import float_vectors_to_matrix, hamming_distances
+
+################################################################################
+# Benchmark of binary search followed by float rescoring
+# Loads a sample of float embeddings, holds some rows out as queries, and for
+# several over-fetch factors R reports recall@k against exact cosine similarity
+# together with the latency of Hamming top k x R + rescoring.
+
+
+# Function to read the first rows of the float embedding shards
+def load_sample(files: list[str], num_rows: int) -> np.ndarray:
+    matrices = []
+    remaining = num_rows
+
+    for file in files:
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=min(remaining, 50_000), columns=["vector"]):
+            matrices.append(float_vectors_to_matrix(batch.column("vector")))
+            remaining -= batch.num_rows
+            if remaining <= 0:
+                return np.concatenate(matrices)[:num_rows]
+
+    return np.concatenate(matrices)
+
+
+# Function to find the k best rows by Hamming distance
+def hamming_top_k(matrix: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    distances = hamming_distances(matrix, query)
+    k = min(k, len(distances))
+    candidates = np.argpartition(distances, k - 1)[:k]
+    return candidates[np.argsort(distances[candidates], kind="stable")]
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark binary search with float rescoring")
+    parser.add_argument("--float-folder", default="float_embeddings/data")
+    parser.add_argument("--corpus-rows", type=int, default=200_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--factors", default="1,2,4,8,16")
+    parser.add_argument("--dtype", choices=["int8", "float16"], default="int8")
+    parser.add_argument("--output", default="bench_rescore.json")
+    args = parser.parse_args()
+
+    files = glob(f"{args.float_folder}/*.parquet")
+    files.sort()
+
+    # Corpus and held out queries, as unit vectors
+    sample = normalize(load_sample(files, args.corpus_rows + args.queries))
+    queries, corpus = sample[: args.queries], sample[args.queries :]
+    print(f"Corpus of {len(corpus)} rows, {len(queries)} queries")
+
+    # Binary vectors, as stored in the vector database
+    corpus_binary = np.packbits(corpus >= 0, axis=1)
+    queries_binary = np.packbits(queries >= 0, axis=1)
+
+    # Compact document vectors for rescoring
+    if args.dtype == "int8":
+        ranges = calibrate_ranges(corpus)
+        rescorer = Rescorer(quantize_int8(corpus, ranges), ranges)
+    else:
+        rescorer = Rescorer(corpus.astype(np.float16))
+
+    # Exact ground truth
+    truth = [set(np.argsort(-(corpus @ query))[: args.k]) for query in queries]
+
+    results = []
+    for factor in [int(factor) for factor in args.factors.split(",")]:
+        latencies = []
+        recalls = []
+
+        for query, query_binary, expected in zip(queries, queries_binary, truth):
+            start = perf_counter()
+
+            candidates = hamming_top_k(corpus_binary, query_binary, args.k * factor)
+            found = candidates[rescorer.rerank(query, candidates)[: args.k]]
+
+            latencies.append(perf_counter() - start)
+            recalls.append(len(expected.intersection(found.tolist())) / args.k)
+
+        latencies = np.array(latencies) * 1000
+        result = {
+            "factor": factor,
+            "k": args.k,
+            "dtype": args.dtype,
+            "corpus_rows": len(corpus),
+            f"recall@{args.k}": round(float(np.mean(recalls)), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        }
+        results.append(result)
+        print(result)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"Results written to {args.output}")
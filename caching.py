@@ -0,0 +1,229 @@
+# Import required libraries
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+################################################################################
+# Sentinel to tell apart "not cached" from a cached None (negative result)
+MISSING = object()
+
+
+# Function to normalize free text before using it as a cache key
+def normalize_text(text: str) -> str:
+    # Collapse runs of whitespace and strip the ends, so that trivially
+    # different queries share one entry
+    return " ".join(text.split())
+
+
+# Function to turn a text key into a fixed size digest for the disk tier
+def hash_key(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+
+################################################################################
+# In-memory LRU cache with a memory ceiling and an optional TTL
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float | None = None, sizeof=None):
+        # Upper bound on the (approximate) size of keys + values held
+        self.max_bytes = max_bytes
+
+        # Seconds after which an entry is considered stale, None to disable
+        self.ttl = ttl
+
+        # Function to estimate the size of an entry, defaults to len(key) + len(value)
+        self.sizeof = sizeof or (lambda key, value: len(key) + (len(value) if value else 0))
+
+        # key -> (value, size, stored_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # Not cached
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, stored_at = entry
+
+            # Cached but stale
+            if self.ttl is not None and time() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+
+        # Never hold a single entry that is bigger than the whole cache
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, time())
+            self._bytes += size
+
+            # Evict least recently used entries until we are under the ceiling
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+################################################################################
+# On-disk cache backed by SQLite, shared between workers and restarts
+
+
+class SQLiteCache:
+    def __init__(self, path: str, table: str = "cache", ttl: float | None = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+
+        # One connection shared by the threads of this process. WAL lets other
+        # worker processes read while one of them writes.
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key BLOB PRIMARY KEY, value BLOB, stored_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+
+            # Not cached, or cached but stale
+            if row is None or (self.ttl is not None and time() - row[1] > self.ttl):
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: bytes, value: bytes | None):
+        # A None value is stored as NULL, which callers can use for negative results
+        with self._lock:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, time()),
+            )
+            self._connection.commit()
+
+    def purge_expired(self) -> int:
+        # Remove stale entries to keep the file small
+        if self.ttl is None:
+            return 0
+
+        with self._lock:
+            cursor = self._connection.execute(
+                f"DELETE FROM {self.table} WHERE stored_at < ?", (time() - self.ttl,)
+            )
+            self._connection.commit()
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+################################################################################
+# Two tier cache for query embeddings: memory first, then disk
+
+
+class EmbeddingCache:
+    def __init__(self, memory: LRUCache, disk: SQLiteCache | None = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, text: str) -> bytes | None:
+        key = normalize_text(text)
+
+        # Memory tier
+        vector = self.memory.get(key)
+        if vector is not None:
+            return vector
+
+        # Disk tier, promote to memory on a hit
+        if self.disk is not None:
+            vector = self.disk.get(hash_key(key))
+            if vector is not None:
+                self.memory.put(key, vector)
+                return vector
+
+        return None
+
+    def put(self, text: str, vector: bytes):
+        key = normalize_text(text)
+
+        self.memory.put(key, vector)
+
+        if self.disk is not None:
+            self.disk.put(hash_key(key), vector)
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
@@ -0,0 +1,126 @@
+# Import required libraries
+import json
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+################################################################################
+# Checkpoints for long running per-shard jobs
+# A shard is processed in row ranges. The output of every range is written to
+# its own part file and the range is recorded in checkpoint.json once the part
+# is complete, so a run that dies midway resumes at the first missing range.
+# When all ranges are done the parts are merged into the shard's output.
+# Checkpoints and outputs record the rows and size of the shard they were made
+# from, so parts and outputs of an older snapshot of the same shard are redone.
+#
+# Merging reads every part back and writes the shard once more. That is the
+# price of resuming: a parquet file being written cannot be read before it is
+# closed, so a run that dies would otherwise lose the whole shard. The parts are
+# read sequentially and compressed, which takes far less than embedding them,
+# and each part is deleted once merged, so the shard is on disk about once.
+
+
+# Function to describe the source shard, what a checkpoint or output belongs to
+def source_fingerprint(path: str) -> dict:
+    return {
+        "file": os.path.basename(path),
+        "rows": pq.ParquetFile(path).metadata.num_rows,
+        "bytes": os.path.getsize(path),
+    }
+
+
+# Function to tell whether an output was merged from the given source
+def output_matches(path: str, source: dict) -> bool:
+    if not os.path.exists(path):
+        return False
+
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(b"source") == json.dumps(source, sort_keys=True).encode()
+
+
+class ShardCheckpoint:
+    def __init__(self, directory: str, rows_per_part: int, source: dict | None = None, names: tuple[str, ...] = ()):
+        self.directory = directory
+        self.rows_per_part = rows_per_part
+        self.source = source
+
+        # Names of the parts written for every range
+        self.names = names
+        self.path = f"{directory}/checkpoint.json"
+
+        os.makedirs(directory, exist_ok=True)
+
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                state = json.load(file)
+
+        # Parts written with another part size do not line up with this run
+        if state is not None and state["rows_per_part"] != rows_per_part:
+            print(f"Discarding checkpoint in {directory}, it was written with {state['rows_per_part']} rows per part.")
+            self.remove()
+            os.makedirs(directory, exist_ok=True)
+            state = None
+
+        # Parts of another snapshot of the shard hold other rows
+        if state is not None and state.get("source") != source:
+            print(f"Discarding checkpoint in {directory}, it was written for {state.get('source')}, not {source}.")
+            self.remove()
+            os.makedirs(directory, exist_ok=True)
+            state = None
+
+        self.completed = {tuple(row_range) for row_range in state["completed"]} if state else set()
+
+        # A merge that died midway has deleted some parts already, their ranges are redone
+        for start, end in sorted(self.completed):
+            if not all(os.path.exists(self.part_path(name, start, end)) for name in names):
+                self.completed.discard((start, end))
+
+        if self.completed:
+            print(f"Resuming from checkpoint in {directory}: {len(self.completed)} parts done.")
+
+    # Function to name the part holding a row range
+    def part_path(self, name: str, start: int, end: int) -> str:
+        return f"{self.directory}/{name}-{start:010d}-{end:010d}.parquet"
+
+    def is_done(self, start: int, end: int) -> bool:
+        return (start, end) in self.completed
+
+    # Function to record a row range, call once all of its parts are written
+    def mark_done(self, start: int, end: int):
+        self.completed.add((start, end))
+
+        # Write to a temporary file first, so a crash never leaves a torn checkpoint
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"rows_per_part": self.rows_per_part, "source": self.source, "completed": sorted(self.completed)}, file)
+        os.replace(temporary_path, self.path)
+
+    # Function to list the parts of the completed ranges, in row order
+    def parts(self, name: str) -> list[str]:
+        return [self.part_path(name, start, end) for start, end in sorted(self.completed)]
+
+    # Function to merge the parts into one parquet file, a row group per part
+    # The output records the source in its metadata, and each part is deleted once merged.
+    def merge(self, name: str, output: str, schema: pa.Schema):
+        temporary = f"{output}.tmp"
+        metadata = {**(schema.metadata or {}), b"source": json.dumps(self.source, sort_keys=True).encode()}
+
+        with pq.ParquetWriter(temporary, schema.with_metadata(metadata)) as writer:
+            for part in self.parts(name):
+                writer.write_table(pq.read_table(part, schema=schema))
+                os.remove(part)
+
+        os.replace(temporary, output)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Function to write a record batch as a part, atomically so a part that exists is always complete
+def write_part(path: str, batch: pa.RecordBatch):
+    temporary = f"{path}.tmp"
+    pq.write_table(pa.Table.from_batches([batch]), temporary)
+    os.replace(temporary, path)
@@ -1,27 +1,236 @@
 # Import required libraries
+import argparse
 import os
+from glob import glob
+from time import strftime, time
 
-from datasets import load_dataset
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
-# Also, whether to split the consolidated file into parts
-# Set 0 for no sharding.
-num_parts = 10
+from shard_manifest import write_shard_manifest
+from text_cleaning import utf8_bytes
 
-# Create a new dataset
-dataset = load_dataset("parquet", data_dir="crossref_metadata/", num_proc=24)
+################################################################################
+# Consolidation of the metadata files into size balanced shards
+# Streams the files written by metadata.py once. Every batch is ordered by year
+# and cut into one slice per shard, sized so that all shards stay equal in
+# weight: bytes of text, or tokens of abstract, which is what embedding costs.
+# Shard k so gets the k-th year range of every batch, and its row groups are
+# sorted by year, which keeps their year statistics narrow.
 
-# Save consolidated dataset
-dataset["train"].to_parquet("crossref_metadata.parquet")
 
-# Save consolidated dataset in parts
-if num_parts:
-    
-    print(f"Splitting consolidated dataset in {num_parts} parts.")
-    
-    split_folder = 'crossref_metadata_split'
-    os.makedirs(split_folder, exist_ok=True)
+# Function to weigh rows by the bytes they hold
+def row_bytes(batch: pa.RecordBatch) -> np.ndarray:
+    weights = np.zeros(batch.num_rows, dtype=np.int64)
 
-    for i in range(num_parts):
-        dataset["train"].shard(num_parts, index=i).to_parquet(
-            f"{split_folder}/part_{i + 1}.parquet"
+    for column in batch.columns:
+        # Authors are a list of names
+        if pa.types.is_list(column.type):
+            column = pc.binary_join(column, "")
+
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            weights += utf8_bytes(column)
+        else:
+            weights += column.type.byte_width
+
+    return weights
+
+
+# Function to weigh rows by the tokens of their abstract, as the model will see them
+def row_tokens(tokenizer, batch: pa.RecordBatch, max_length: int = 512) -> np.ndarray:
+    texts = pc.fill_null(batch.column("abstract"), "").to_pylist()
+    input_ids = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_length)["input_ids"]
+    return np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=batch.num_rows)
+
+
+# Function to cut the rows of a batch into one contiguous slice per shard
+# Sizes the slices so that every shard gets as close as possible to an equal
+# share of all the weight written so far, which corrects for earlier rounding.
+# Returns the boundaries, slice k is rows cuts[k] to cuts[k + 1].
+def balanced_cuts(weights: np.ndarray, assigned: np.ndarray) -> np.ndarray:
+    total = weights.sum()
+    if total == 0:
+        return np.linspace(0, len(weights), len(assigned) + 1).astype(np.int64)
+
+    share = (assigned.sum() + total) / len(assigned)
+    wanted = np.maximum(share - assigned, 0)
+    wanted = wanted * total / wanted.sum()
+
+    # A row goes to the shard its midpoint falls in
+    midpoints = np.cumsum(weights) - weights / 2
+    inner = np.searchsorted(midpoints, np.cumsum(wanted)[:-1])
+
+    return np.concatenate([[0], inner, [len(weights)]])
+
+
+################################################################################
+
+
+class ShardWriter:
+    def __init__(self, path: str, schema: pa.Schema, row_group_size: int, sort_by: str = "", compression: str = "zstd"):
+        self.path = path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.sort_by = sort_by
+
+        # Statistics only on the column row groups are sorted by when there is one,
+        # min and max of abstracts would only grow the footer
+        self.writer = pq.ParquetWriter(
+            f"{path}.tmp",
+            schema,
+            compression=compression,
+            write_statistics=[sort_by] if sort_by else True,
+            sorting_columns=[pq.SortingColumn(schema.get_field_index(sort_by))] if sort_by else None,
         )
+
+        # Rows waiting for a full row group
+        self.buffer = []
+        self.buffered = 0
+
+        self.rows = 0
+        self.weight = 0
+        self.years = []
+
+    def write(self, batch: pa.RecordBatch, weight: int):
+        if not batch.num_rows:
+            return
+
+        self.buffer.append(batch)
+        self.buffered += batch.num_rows
+        self.rows += batch.num_rows
+        self.weight += int(weight)
+
+        year = pc.min_max(batch.column("year"))
+        self.years.extend([year["min"].as_py(), year["max"].as_py()])
+
+        while self.buffered >= self.row_group_size:
+            self.flush(self.row_group_size)
+
+    # Function to write one row group from the buffer, sorted, keeping the rest
+    def flush(self, rows: int | None = None):
+        table = pa.Table.from_batches(self.buffer, self.schema)
+        if self.sort_by:
+            table = table.sort_by(self.sort_by)
+
+        rows = rows or table.num_rows
+        if rows:
+            self.writer.write_table(table.slice(0, rows), row_group_size=rows)
+
+        rest = table.slice(rows)
+        self.buffer = rest.to_batches()
+        self.buffered = rest.num_rows
+
+    # Function to finish the file and describe it for the manifest
+    def close(self) -> dict:
+        if self.buffered:
+            self.flush()
+
+        self.writer.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+        years = [year for year in self.years if year is not None]
+
+        return {
+            "file": os.path.basename(self.path),
+            "rows": self.rows,
+            "weight": self.weight,
+            "bytes": os.path.getsize(self.path),
+            "row_groups": pq.ParquetFile(self.path).metadata.num_row_groups,
+            "year_min": min(years, default=None),
+            "year_max": max(years, default=None),
+        }
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidate the metadata files into size balanced shards")
+    parser.add_argument("--metadata-folder", default="crossref_metadata")
+    parser.add_argument("--split-folder", default="crossref_metadata_split")
+    parser.add_argument("--num-parts", type=int, default=10, help="Set 0 for no sharding")
+    parser.add_argument("--weight", choices=["bytes", "tokens"], default="bytes")
+    parser.add_argument("--tokenizer", default="mixedbread-ai/mxbai-embed-large-v1", help="Counts tokens for --weight tokens")
+    parser.add_argument("--batch-rows", type=int, default=50_000, help="Rows read and split at once")
+    parser.add_argument("--row-group-size", type=int, default=50_000, help="Rows per row group, ROW_GROUP_SIZE of embed_multigpu_split.py")
+    parser.add_argument("--sort-by", default="year", help="Column to sort row groups by, empty to keep the input order")
+    parser.add_argument("--compression", default="zstd")
+    parser.add_argument("--monolithic", action="store_true", help="Also write crossref_metadata.parquet, which embed_all.py reads")
+    args = parser.parse_args()
+
+    start_time = time()
+
+    files = glob(f"{args.metadata_folder}/*.parquet")
+    files.sort()
+    schema = pq.read_schema(files[0])
+
+    tokenizer = None
+    if args.weight == "tokens":
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    os.makedirs(args.split_folder, exist_ok=True)
+    shards = [
+        ShardWriter(f"{args.split_folder}/part_{i + 1}.parquet", schema, args.row_group_size, args.sort_by, args.compression)
+        for i in range(args.num_parts)
+    ]
+
+    # The single file keeps the input order
+    monolithic = ShardWriter("crossref_metadata.parquet", schema, args.row_group_size, "", args.compression) if args.monolithic else None
+
+    assigned = np.zeros(len(shards), dtype=np.int64)
+    rows = 0
+
+    for file in files:
+        print(f"Reading: {file}")
+
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=args.batch_rows):
+            rows += batch.num_rows
+
+            if monolithic is not None:
+                monolithic.write(batch, 0)
+
+            if not shards:
+                continue
+
+            weights = row_bytes(batch) if tokenizer is None else row_tokens(tokenizer, batch)
+
+            if args.sort_by:
+                order = pc.sort_indices(batch, sort_keys=[(args.sort_by, "ascending")])
+                batch = batch.take(order)
+                weights = weights[order.to_numpy()]
+
+            cuts = balanced_cuts(weights, assigned)
+            for i, shard in enumerate(shards):
+                start, end = int(cuts[i]), int(cuts[i + 1])
+                shard.write(batch.slice(start, end - start), weights[start:end].sum())
+                assigned[i] += weights[start:end].sum()
+
+    if monolithic is not None:
+        monolithic.close()
+        print("Saved consolidated dataset to crossref_metadata.parquet")
+
+    if shards:
+        described = [shard.close() for shard in shards]
+        weights = [shard["weight"] for shard in described]
+
+        manifest = {
+            "created": strftime("%Y-%m-%d %H:%M:%S"),
+            "source": args.metadata_folder,
+            "files": len(files),
+            "rows": rows,
+            "weight": args.weight,
+            "sort_by": args.sort_by,
+            "row_group_size": args.row_group_size,
+            # Heaviest shard over the average, 1.0 is a perfect split
+            "imbalance": max(weights) / max(np.mean(weights), 1),
+            "shards": described,
+        }
+        path = write_shard_manifest(args.split_folder, manifest)
+
+        print(f"Split {rows} rows in {len(shards)} parts, imbalance {manifest['imbalance']:.4f}, manifest at {path}")
+
+    end_time = time()
+    print(f"Consolidated {rows} rows in {end_time - start_time:.0f} seconds, {rows / (end_time - start_time):.0f} rows/second")
@@ -0,0 +1,157 @@
+# Import required libraries
+import threading
+from concurrent.futures import Future
+from urllib.parse import quote_plus
+
+import backoff
+import requests
+from requests.adapters import HTTPAdapter
+
+from caching import MISSING, SQLiteCache, hash_key
+
+################################################################################
+# Client to fetch abstracts from the Crossref REST API
+# https://api.crossref.org/swagger-ui/index.html
+
+
+class CrossrefClient:
+    def __init__(
+        self,
+        base_url: str = "https://api.crossref.org",
+        cache_path: str | None = None,
+        ttl: float | None = 30 * 24 * 3600,
+        negative_ttl: float | None = 24 * 3600,
+        timeout: float = 5,
+        max_tries: int = 3,
+        max_time: float = 10,
+        pool_size: int = 16,
+        mailto: str | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.max_time = max_time
+
+        # One session for all lookups, so connections are kept alive and reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Identifying ourselves gets us into Crossref's "polite" pool
+        if mailto:
+            self.session.headers["User-Agent"] = f"PaperMatch (mailto:{mailto})"
+
+        # Persistent DOI -> abstract cache. Found abstracts and "no abstract"
+        # answers are kept in separate tables so they can expire independently.
+        if cache_path:
+            self.cache = SQLiteCache(cache_path, table="abstracts", ttl=ttl)
+            self.negative_cache = SQLiteCache(cache_path, table="missing_abstracts", ttl=negative_ttl)
+        else:
+            self.cache = None
+            self.negative_cache = None
+
+        # DOI -> Future of the upstream call currently in flight
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    # Function to get the abstract of a DOI, None when Crossref has none
+    def get_abstract(self, doi: str) -> str | None:
+        # DOIs are case insensitive
+        key = doi.lower()
+
+        # Check the cache first
+        cached = self._cached(key)
+        if cached is not MISSING:
+            return cached
+
+        # Join the lookup already in flight for this DOI, or start one
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            abstract = self._fetch(doi)
+            self._store(key, abstract)
+            future.set_result(abstract)
+            return abstract
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _cached(self, key: str):
+        if self.cache is None:
+            return MISSING
+
+        abstract = self.cache.get(hash_key(key))
+        if abstract is not None:
+            return abstract.decode("utf-8")
+
+        if self.negative_cache.get(hash_key(key), MISSING) is not MISSING:
+            return None
+
+        return MISSING
+
+    def _store(self, key: str, abstract: str | None):
+        if self.cache is None:
+            return
+
+        if abstract:
+            self.cache.put(hash_key(key), abstract.encode("utf-8"))
+        else:
+            self.negative_cache.put(hash_key(key), None)
+
+    def _fetch(self, doi: str) -> str | None:
+        # Retry transient failures, but never hold the caller for more than max_time
+        retrying_request = backoff.on_exception(
+            wait_gen=backoff.expo,
+            exception=requests.exceptions.RequestException,
+            jitter=backoff.full_jitter,
+            max_tries=self.max_tries,
+            max_time=self.max_time,
+            giveup=lambda e: e.response is not None and e.response.status_code < 500 and e.response.status_code != 429,
+        )(self._request)
+
+        return retrying_request(doi)
+
+    def _request(self, doi: str) -> str | None:
+        self.upstream_calls += 1
+
+        # URL encode the doi
+        crossref_api_url = f"{self.base_url}/works/{quote_plus(doi)}"
+
+        response = self.session.get(crossref_api_url, timeout=self.timeout)
+
+        # Unknown DOI, this is an answer rather than an error
+        if response.status_code == 404:
+            return None
+
+        response.raise_for_status()
+
+        return response.json().get("message", {}).get("abstract")
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "negative_cache": self.negative_cache.stats() if self.negative_cache is not None else None,
+        }
+
+    def close(self):
+        self.session.close()
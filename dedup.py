@@ -0,0 +1,109 @@
+# Import required libraries
+import argparse
+import hashlib
+import json
+import re
+import unicodedata
+from glob import glob
+
+import numpy as np
+import pyarrow.parquet as pq
+
+################################################################################
+# Deduplication of abstracts
+# Many DOIs share an abstract: preprints and their published versions,
+# translations, component DOIs. Abstracts are hashed after normalization, each
+# unique abstract is embedded once and its vector fanned out to every row that
+# shares it. The same hash lets the app group duplicate papers in results.
+
+# Markup such as <jats:p>, which differs between otherwise identical records
+tag_pattern = re.compile(r"<[^>]+>")
+
+
+# Function to reduce an abstract to what the model sees
+# The tokenizer of the model lowercases, so case does not matter either.
+def normalize_abstract(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "")
+    text = tag_pattern.sub(" ", text)
+    return " ".join(text.casefold().split())
+
+
+def abstract_hash(text: str) -> bytes:
+    return hashlib.blake2b(normalize_abstract(text).encode("utf-8"), digest_size=16).digest()
+
+
+# Function to hash many abstracts into a numpy array of 16 byte strings
+def abstract_hashes(texts: list[str]) -> np.ndarray:
+    return np.array([abstract_hash(text) for text in texts], dtype="S16")
+
+
+# Function to embed every unique abstract once and fan the vectors out to all rows
+# encode takes a list of texts and returns a matrix with a row per text.
+# Returns the embeddings of all rows and the number of abstracts embedded.
+def encode_unique(encode, texts: list[str]) -> tuple[np.ndarray, int]:
+    if not texts:
+        return encode(texts), 0
+
+    # First row of every unique abstract, and which unique abstract every row has
+    _, first, inverse = np.unique(abstract_hashes(texts), return_index=True, return_inverse=True)
+
+    embeddings = encode([texts[index] for index in first])
+
+    return embeddings[inverse], len(first)
+
+
+################################################################################
+# Report of how much embedding deduplication saves over the metadata shards
+# Counts unique abstracts per embedding batch, which is what the embed scripts
+# save, and over the whole corpus, the upper bound. GPU hours follow from the
+# measured embedding throughput of one GPU.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report duplicate abstracts and the GPU hours deduplication saves")
+    parser.add_argument("--metadata-folder", default="crossref_metadata_split")
+    parser.add_argument("--batch-rows", type=int, default=50_000, help="Rows embedded together, ROW_GROUP_SIZE of embed_multigpu_split.py")
+    parser.add_argument("--rows-per-second", type=float, required=True, help="Embedding throughput of one GPU")
+    parser.add_argument("--output", default="dedup_report.json")
+    args = parser.parse_args()
+
+    files = glob(f"{args.metadata_folder}/**/*.parquet", recursive=True)
+    files.sort()
+
+    rows = 0
+    unique_in_batches = 0
+
+    # First 8 bytes of every hash, enough to count unique abstracts over ~100M rows
+    corpus_hashes = []
+
+    for file in files:
+        print(f"Reading: {file}")
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=args.batch_rows, columns=["abstract"]):
+            hashes = abstract_hashes(batch.column("abstract").to_pylist())
+
+            rows += len(hashes)
+            unique_in_batches += len(np.unique(hashes))
+            corpus_hashes.append(np.frombuffer(hashes.tobytes(), dtype=np.uint64)[::2].copy())
+
+    unique_in_corpus = len(np.unique(np.concatenate(corpus_hashes))) if corpus_hashes else 0
+
+    # Hours of one GPU to embed a number of rows
+    def gpu_hours(count):
+        return count / args.rows_per_second / 3600
+
+    report = {
+        "rows": rows,
+        "unique_in_batches": unique_in_batches,
+        "unique_in_corpus": unique_in_corpus,
+        "batch_rows": args.batch_rows,
+        "rows_per_second": args.rows_per_second,
+        "gpu_hours_without_dedup": round(gpu_hours(rows), 2),
+        "gpu_hours_saved_in_batches": round(gpu_hours(rows - unique_in_batches), 2),
+        "gpu_hours_saved_in_corpus": round(gpu_hours(rows - unique_in_corpus), 2),
+    }
+    print(report)
+
+    # Save machine readable results
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"Report written to {args.output}")
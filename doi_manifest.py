@@ -0,0 +1,93 @@
+# Import required libraries
+import hashlib
+import sqlite3
+
+import pyarrow as pa
+
+################################################################################
+# Manifest of the DOIs in the collection and a hash of each row's content
+# Lets an ingestion run work out which rows are new, changed or retracted
+# without reading anything back from Milvus.
+
+# Fields that make up the content hash of a row
+hashed_fields = ["title", "author", "abstract", "month", "year", "URL", "vector"]
+
+
+# Function to hash the content of every row of a batch
+def row_hashes(batch: pa.RecordBatch) -> list[bytes]:
+    columns = [batch.column(field).to_pylist() for field in hashed_fields]
+
+    hashes = []
+    for values in zip(*columns):
+        digest = hashlib.blake2b(digest_size=16)
+        for value in values:
+            digest.update(value if isinstance(value, bytes) else str(value).encode("utf-8"))
+            digest.update(b"\x00")
+        hashes.append(digest.digest())
+
+    return hashes
+
+
+################################################################################
+
+
+class DOIManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS manifest (doi TEXT PRIMARY KEY, hash BLOB NOT NULL, seen INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+
+    # Function to start a run, every DOI counts as retracted until it is seen again
+    def begin(self):
+        self.connection.execute("UPDATE manifest SET seen = 0")
+        self.connection.commit()
+
+    # Function to find which rows of a batch are new or changed
+    def diff(self, dois: list[str], hashes: list[bytes]) -> list[int]:
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS incoming (position INTEGER, doi TEXT, hash BLOB)")
+        self.connection.execute("DELETE FROM incoming")
+        self.connection.executemany(
+            "INSERT INTO incoming VALUES (?, ?, ?)", zip(range(len(dois)), dois, hashes)
+        )
+
+        changed = self.connection.execute(
+            """
+            SELECT incoming.position FROM incoming
+            LEFT JOIN manifest ON manifest.doi = incoming.doi
+            WHERE manifest.hash IS NULL OR manifest.hash != incoming.hash
+            ORDER BY incoming.position
+            """
+        ).fetchall()
+
+        return [position for (position,) in changed]
+
+    # Function to record rows as present in the collection, call once they are written
+    def record(self, dois: list[str], hashes: list[bytes]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO manifest (doi, hash, seen) VALUES (?, ?, 1)", zip(dois, hashes)
+        )
+        self.connection.commit()
+
+    # Function to list the DOIs not seen in this run
+    def retracted(self) -> list[str]:
+        return [doi for (doi,) in self.connection.execute("SELECT doi FROM manifest WHERE seen = 0")]
+
+    # Function to forget DOIs, call once they are deleted from the collection
+    def forget(self, dois: list[str]):
+        self.connection.executemany("DELETE FROM manifest WHERE doi = ?", ((doi,) for doi in dois))
+        self.connection.commit()
+
+    # Function to replace the manifest, after a full rebuild
+    def reset(self):
+        self.connection.execute("DELETE FROM manifest")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -2,15 +2,24 @@
 from sentence_transformers import SentenceTransformer  # Embedding model
 from datasets import load_dataset
 
+from batching import encode_bucketed
+from dedup import encode_unique
+
 # Declare batch size
 BATCH_SIZE = 96
 
 # Define the embedding model
 model = SentenceTransformer("mixedbread-ai/mxbai-embed-large-v1")
 
+# Padded tokens per batch, rows are bucketed by length to fill it
+MAX_BATCH_TOKENS = BATCH_SIZE * model.max_seq_length
+
 # Function to create embeddings
 def embed(rows):
-    embeddings = model.encode(rows["abstract"], batch_size=BATCH_SIZE, show_progress_bar=True, convert_to_numpy=True)
+    # Rows sharing an abstract get the vector of its one embedding
+    embeddings, _ = encode_unique(
+        lambda texts: encode_bucketed(model, texts, MAX_BATCH_TOKENS, show_progress_bar=True), rows["abstract"]
+    )
     return {'vector' : embeddings}
 
 # Create a new dataset
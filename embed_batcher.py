@@ -0,0 +1,138 @@
+# Import required libraries
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+
+################################################################################
+# Micro-batching of query embeddings
+# Concurrent searches each embed one text, while the API and the local model
+# both take lists. The batcher holds the first waiting text for a window of a
+# few milliseconds, or until max_batch_size texts are waiting, and embeds them
+# with one call. Every caller blocks until its own vector comes back.
+# Identical texts in a batch are embedded once.
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        embed_batch,
+        max_batch_size: int = 32,
+        window_ms: float = 5,
+        max_in_flight: int = 4,
+        name: str = "embed",
+        metrics_window: int = 1000,
+    ):
+        # embed_batch takes a list of texts and returns one vector per text
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+
+        # Texts waiting for a batch, with the future to answer and when they arrived
+        self._queue = queue.SimpleQueue()
+
+        # Batches being embedded at once. While all are busy the dispatcher does
+        # not collect, so the waiting texts go out together in the next batch.
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=f"{name}_batch")
+
+        # Size of the latest batches and time their texts waited, in seconds
+        self._sizes = deque(maxlen=metrics_window)
+        self._delays = deque(maxlen=metrics_window)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+
+        self._closing = False
+        self._thread = threading.Thread(target=self._dispatch, name=f"{name}_batcher", daemon=True)
+        self._thread.start()
+
+    # Function to embed one text, together with whatever else is waiting
+    def embed(self, text: str):
+        future = Future()
+        self._queue.put((text, future, perf_counter()))
+        return future.result()
+
+    # Function to gather the next batch
+    # Blocks for the first text, then takes more until the window closes or the batch is full.
+    def _collect(self) -> list:
+        batch = []
+        closes = None
+
+        while len(batch) < self.max_batch_size:
+            try:
+                if closes is None:
+                    item = self._queue.get()
+                    closes = perf_counter() + self.window
+                else:
+                    item = self._queue.get(timeout=max(closes - perf_counter(), 0))
+            except queue.Empty:
+                break
+
+            # Sent by close
+            if item is None:
+                self._closing = True
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _dispatch(self):
+        while not self._closing:
+            self._slots.acquire()
+
+            batch = self._collect()
+            if not batch:
+                self._slots.release()
+                continue
+
+            dispatched = perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.texts += len(batch)
+                self._sizes.append(len(batch))
+                self._delays.extend(dispatched - arrived for _, _, arrived in batch)
+
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch: list):
+        try:
+            # Embed every distinct text once
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            vectors = dict(zip(texts, self.embed_batch(texts)))
+
+            for text, future, _ in batch:
+                future.set_result(vectors[text])
+
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = list(self._sizes)
+            delays = sorted(self._delays)
+
+        if not sizes:
+            return {"batches": self.batches, "texts": self.texts}
+
+        mean_size = sum(sizes) / len(sizes)
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(mean_size, 2),
+            "mean_fill": round(mean_size / self.max_batch_size, 3),
+            "p50_queue_ms": round(delays[len(delays) // 2] * 1000, 2),
+            "p95_queue_ms": round(delays[min(len(delays) - 1, int(len(delays) * 0.95))] * 1000, 2),
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
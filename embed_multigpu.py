@@ -3,13 +3,16 @@ import os
 from multiprocess import set_start_method
 from time import time
 
-from sentence_transformers import SentenceTransformer
-import numpy as np
 from huggingface_hub import snapshot_download
 from dotenv import load_dotenv
 import torch
 from datasets import load_dataset
 
+from batching import encode_bucketed
+from dedup import encode_unique
+from embedding_backend import load_model, quantized_onnx_file
+from vectors import binarise_table
+
 start_time = time()
 ################################################################################
 
@@ -20,10 +23,27 @@ load_dotenv('.env')
 BATCH_SIZE = int(os.getenv('BATCH_SIZE'))
 print(f'Using BATCH SIZE: {BATCH_SIZE}')
 
+# Padded tokens per batch, rows are bucketed by length to fill it. Defaults to
+# BATCH_SIZE abstracts of the longest length the model reads, which fits the GPU.
+MAX_BATCH_TOKENS = int(os.getenv('MAX_BATCH_TOKENS') or 0)
+
+# Rows handed to each embedding call, sorted into length buckets there
+BUCKET_ROWS = 10_000
+
+# Rows binarised at once, as whole Arrow batches rather than row by row
+BINARISE_BATCH_SIZE = 10_000
+
 # Define the embedding model
 embedding_model_name = "mixedbread-ai/mxbai-embed-large-v1"
 print(f'Using embedding model: {embedding_model_name}')
-model = SentenceTransformer(embedding_model_name, device='cpu')
+
+# Without a GPU, run the int8 quantized ONNX export on the CPU instead
+GPU_COUNT = torch.cuda.device_count()
+ONNX_FILE = None if GPU_COUNT else (os.getenv('EMBEDDING_ONNX_FILE') or quantized_onnx_file)
+print(f'Using {GPU_COUNT} GPUs' if GPU_COUNT else f'No GPU found, using {ONNX_FILE} on the CPU')
+model = load_model(embedding_model_name, onnx_file=ONNX_FILE)
+MAX_BATCH_TOKENS = MAX_BATCH_TOKENS or BATCH_SIZE * model.max_seq_length
+print(f'Using MAX BATCH TOKENS: {MAX_BATCH_TOKENS}')
 
 ################################################################################
 
@@ -42,33 +62,21 @@ print(f'Will upload float embeddings to {embedding_repo_id} and binary to {embed
 def embed_metadata(batch, rank):
     
     # Move the model on the right GPU if it's not there already
-    device = f"cuda:{(rank or 0) % torch.cuda.device_count()}"
-    print(f'Loading Embedding model to GPU:{device}')
-    model.to(device)
+    if GPU_COUNT:
+        device = f"cuda:{(rank or 0) % GPU_COUNT}"
+        print(f'Loading Embedding model to GPU:{device}')
+        model.to(device)
 
-    # Calculate the embeddings for text and paragraphs
-    batch["vector"] = model.encode(
+    # Calculate the embeddings, in batches of similar length.
+    # Rows sharing an abstract get the vector of its one embedding.
+    batch["vector"], embedded = encode_unique(
+        lambda texts: encode_bucketed(model, texts, MAX_BATCH_TOKENS, show_progress_bar=True),
         batch["abstract"],
-        batch_size=BATCH_SIZE,
-        show_progress_bar=True,
-        convert_to_numpy=True,
     )
+    print(f'Embedded {embedded} unique abstracts of {len(batch["abstract"])}')
     
     return batch
 
-# Function to binarise float embeddings
-def binarise(row):
-    # Make it a numpy array, since batching sends it as list
-    float_vector = np.array(row['vector'], dtype=np.float32)
-    
-    # Binarise
-    binary_vector = np.where(float_vector >= 0, 1, 0)
-    
-    # Pack it to make it milvus compatible
-    row['vector'] = np.packbits(binary_vector).tobytes()
-    
-    return row
-    
 ################################################################################
 
 if __name__ == "__main__":
@@ -84,9 +92,9 @@ if __name__ == "__main__":
     dataset = dataset.map(
         embed_metadata,
         batched=True,
-        batch_size=BATCH_SIZE,
+        batch_size=BUCKET_ROWS,
         with_rank=True,
-        num_proc=torch.cuda.device_count(),  # one process per GPU
+        num_proc=GPU_COUNT or None,  # one process per GPU, ONNX Runtime threads on the CPU
     )
     
     # Upload floats
@@ -95,7 +103,7 @@ if __name__ == "__main__":
     
     # Binarise embeddings
     print('Binarising vectors')
-    dataset = dataset.map(binarise)
+    dataset = dataset.with_format('arrow').map(binarise_table, batched=True, batch_size=BINARISE_BATCH_SIZE).with_format(None)
     
     # Upload binarised vectors
     print('Uploading binary embeddings')
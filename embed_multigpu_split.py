@@ -1,15 +1,20 @@
 # Import required libraries
 import os
-from multiprocess import set_start_method
+from concurrent.futures import ThreadPoolExecutor
 from time import time
-from glob import glob
 
-from sentence_transformers import SentenceTransformer
-import numpy as np
 from huggingface_hub import snapshot_download, HfApi
 from dotenv import load_dotenv
+import pyarrow as pa
 import torch
-from datasets import load_dataset
+import pyarrow.parquet as pq
+
+from batching import encode_bucketed
+from embedding_backend import load_model, quantized_onnx_file
+from checkpoint import ShardCheckpoint, output_matches, source_fingerprint, write_part
+from dedup import encode_unique
+from shard_manifest import shard_files
+from vectors import binarise_vectors, matrix_to_float_vectors
 
 start_time = time()
 ################################################################################
@@ -21,10 +26,28 @@ load_dotenv('.env')
 BATCH_SIZE = int(os.getenv('BATCH_SIZE'))
 print(f'Using BATCH SIZE: {BATCH_SIZE}')
 
+# Padded tokens per batch, rows are bucketed by length to fill it. Defaults to
+# BATCH_SIZE abstracts of the longest length the model reads, which fits the GPU.
+MAX_BATCH_TOKENS = int(os.getenv('MAX_BATCH_TOKENS') or 0)
+
+# Rows read from a shard, embedded and written as one parquet row group at a time.
+# Also the unit of checkpointing: a run that dies resumes at the first missing group.
+ROW_GROUP_SIZE = 50_000
+
+# Parts of the shards being embedded, kept until the shard is complete
+checkpoint_folder = 'embedding_checkpoints'
+
 # Define the embedding model
 embedding_model_name = "mixedbread-ai/mxbai-embed-large-v1"
 print(f'Using embedding model: {embedding_model_name}')
-model = SentenceTransformer(embedding_model_name, device='cpu')
+
+# Without a GPU, run the int8 quantized ONNX export on the CPU instead
+GPU_COUNT = torch.cuda.device_count()
+ONNX_FILE = None if GPU_COUNT else (os.getenv('EMBEDDING_ONNX_FILE') or quantized_onnx_file)
+print(f'Using {GPU_COUNT} GPUs' if GPU_COUNT else f'No GPU found, using {ONNX_FILE} on the CPU')
+model = load_model(embedding_model_name, onnx_file=ONNX_FILE)
+MAX_BATCH_TOKENS = MAX_BATCH_TOKENS or BATCH_SIZE * model.max_seq_length
+print(f'Using MAX BATCH TOKENS: {MAX_BATCH_TOKENS}')
 
 # Create huggingface client to transact
 hf_client = HfApi(token=os.getenv('HF_API_KEY'))
@@ -37,9 +60,8 @@ metadata_repo_id = os.getenv('HF_REPO_METADATA_SPLIT')
 print(f'Download metadata from: {metadata_repo_id}')
 snapshot_download(repo_id=metadata_repo_id, repo_type='dataset', local_dir=metadata_repo_id)
 
-# Gather individual files
-metadata_files = glob(f'{metadata_repo_id}/**/*.parquet', recursive=True)
-metadata_files.sort()
+# Gather individual files, as listed by the shard manifest when the repo has one
+metadata_files = shard_files(metadata_repo_id)
 
 # Repo names to upload data to. 
 embedding_repo_id = os.getenv('HF_REPO_EMBEDDING_SPLIT', f'{hf_username}/crossref_metadata_embeddings_split_2025')
@@ -53,90 +75,116 @@ os.makedirs(embedding_repo_id_binary, exist_ok=True)
 print(f'Will upload binary embeddings to {embedding_repo_id_binary}.')
 ################################################################################
 
-def embed_metadata(batch, rank):
-    
-    # Move the model on the right GPU if it's not there already
-    device = f"cuda:{(rank or 0) % torch.cuda.device_count()}"
-    print(f'Loading Embedding model to GPU:{device}')
-    model.to(device)
-
-    # Calculate the embeddings for text and paragraphs
-    batch["vector"] = model.encode(
-        batch["abstract"],
-        batch_size=BATCH_SIZE,
-        show_progress_bar=True,
-        convert_to_numpy=True,
-    )
-    
-    return batch
-
-# Function to binarise float embeddings
-def binarise(row):
-    # Make it a numpy array, since batching sends it as list
-    float_vector = np.array(row['vector'], dtype=np.float32)
-    
-    # Binarise
-    binary_vector = np.where(float_vector >= 0, 1, 0)
-    
-    # Pack it to make it milvus compatible
-    row['vector'] = np.packbits(binary_vector).tobytes()
-    
-    return row
-    
+# Function to embed a shard, writing float and binary row groups as each batch is encoded
+def embed_file(metadata_file, pool):
+
+    name = os.path.basename(metadata_file)
+    float_embedding_name = f'{embedding_repo_id}/{name}'
+    binary_embedding_name = f'{embedding_repo_id_binary}/{name}'
+
+    # Both outputs are written atomically, so existing ones are complete, but
+    # they may come from an older snapshot of the shard under the same name
+    source = source_fingerprint(metadata_file)
+    if output_matches(float_embedding_name, source) and output_matches(binary_embedding_name, source):
+        print(f"Already embedded: {float_embedding_name} and {binary_embedding_name}")
+        return float_embedding_name, binary_embedding_name
+
+    print(f"Saving files to: {float_embedding_name} and {binary_embedding_name}")
+
+    metadata = pq.ParquetFile(metadata_file)
+    checkpoint = ShardCheckpoint(f"{checkpoint_folder}/{name.removesuffix('.parquet')}", ROW_GROUP_SIZE, source, names=('float', 'binary'))
+
+    # Same columns as the metadata, plus the vector
+    float_schema = metadata.schema_arrow.append(pa.field('vector', pa.list_(pa.float32())))
+    binary_schema = metadata.schema_arrow.append(pa.field('vector', pa.binary()))
+
+    start = 0
+    for batch in metadata.iter_batches(batch_size=ROW_GROUP_SIZE):
+        end = start + batch.num_rows
+
+        # Skip the rows embedded by an earlier run
+        if checkpoint.is_done(start, end):
+            start = end
+            continue
+
+        # Calculate the embeddings on every GPU (or the CPU), in batches of similar length.
+        # Rows sharing an abstract get the vector of its one embedding.
+        vectors, embedded = encode_unique(
+            lambda texts: encode_bucketed(model, texts, MAX_BATCH_TOKENS, pool=pool, show_progress_bar=True),
+            batch.column('abstract').to_pylist(),
+        )
+
+        # Write the floats, then binarise the same matrix while it is in memory
+        write_part(checkpoint.part_path('float', start, end), batch.append_column('vector', matrix_to_float_vectors(vectors)))
+        write_part(checkpoint.part_path('binary', start, end), batch.append_column('vector', binarise_vectors(vectors, pa.binary())))
+
+        checkpoint.mark_done(start, end)
+        print(f"Embedded rows {start} to {end} of {metadata.metadata.num_rows}, {embedded} unique abstracts")
+
+        start = end
+
+    # Put the parts together, one row group each
+    checkpoint.merge('float', float_embedding_name, float_schema)
+    checkpoint.merge('binary', binary_embedding_name, binary_schema)
+    checkpoint.remove()
+
+    return float_embedding_name, binary_embedding_name
+
+# Function to upload a file and remove it afterwards
+def upload(file_name, repo_id):
+    print(f'Uploading: {file_name}')
+    hf_client.upload_file(path_or_fileobj=file_name, path_in_repo=f'data/{os.path.basename(file_name)}', repo_id=repo_id, repo_type='dataset')
+
+    print(f'Removing: {file_name}')
+    os.remove(file_name)
+
 ################################################################################
 
 if __name__ == "__main__":
-    # Set context for GPU multiprocess
-    set_start_method('spawn')
-    
-    # Iterate over the metadata files
-    for metadata_file in metadata_files:
-        
-    
-        # Load dataset
-        print(f'Processing: {metadata_file}')
-        dataset = load_dataset("parquet", data_files=metadata_file, split='train')
-    
-        # Embed
-        print('Embedding abstracts')
-        dataset = dataset.map(
-            embed_metadata,
-            batched=True,
-            batch_size=BATCH_SIZE,
-            with_rank=True,
-            num_proc=torch.cuda.device_count(),  # one process per GPU
-        )
-        
-        # Save to parquet
-        float_embedding_name = f'{embedding_repo_id}/{os.path.basename(metadata_file)}'
-        print(f"Saving file to: {float_embedding_name}")
-        dataset.to_parquet(float_embedding_name)
-        
-        # Upload floats
-        print('Uploading float embeddings')
-        hf_client.upload_file(path_or_fileobj=float_embedding_name, path_in_repo=f'data/{os.path.basename(metadata_file)}', repo_id=embedding_repo_id, repo_type='dataset')
-        
-        # Cleanup floats
-        print(f'Removing float file: {float_embedding_name}')
-        os.remove(float_embedding_name)
-        
-        # Binarise embeddings
-        print('Binarising vectors')
-        dataset = dataset.map(binarise)
-        
-        # Save to parquet
-        binary_embedding_name = f'{embedding_repo_id_binary}/{os.path.basename(metadata_file)}'
-        print(f"Saving file to: {binary_embedding_name}")
-        dataset.to_parquet(binary_embedding_name)
-        
-        # Upload floats
-        print('Uploading binary embeddings')
-        hf_client.upload_file(path_or_fileobj=binary_embedding_name, path_in_repo=f'data/{os.path.basename(metadata_file)}', repo_id=embedding_repo_id_binary, repo_type='dataset')
-        
-        print(f'Removing binary file: {binary_embedding_name}')
-        os.remove(binary_embedding_name)
-        
-    
+    # One worker process per GPU, ONNX Runtime runs its own threads on the CPU
+    pool = model.start_multi_process_pool() if GPU_COUNT else None
+
+    # Shards already in the target repos are not embedded again
+    uploaded = {
+        embedding_repo_id: set(hf_client.list_repo_files(repo_id=embedding_repo_id, repo_type='dataset')),
+        embedding_repo_id_binary: set(hf_client.list_repo_files(repo_id=embedding_repo_id_binary, repo_type='dataset')),
+    }
+
+    # Uploads run in the background while the next shard is embedded
+    uploads = []
+
+    with ThreadPoolExecutor(max_workers=2) as uploader:
+
+        # Iterate over the metadata files
+        for metadata_file in metadata_files:
+
+            name = os.path.basename(metadata_file)
+            missing = [repo_id for repo_id, files in uploaded.items() if f'data/{name}' not in files]
+
+            if not missing:
+                print(f'Skipping: {metadata_file}, already uploaded')
+                continue
+
+            print(f'Processing: {metadata_file}')
+            float_embedding_name, binary_embedding_name = embed_file(metadata_file, pool)
+
+            # Bound disk usage to the shard being uploaded and the shard being embedded
+            for future in uploads:
+                future.result()
+
+            uploads = []
+            for file_name, repo_id in [(float_embedding_name, embedding_repo_id), (binary_embedding_name, embedding_repo_id_binary)]:
+                if repo_id in missing:
+                    uploads.append(uploader.submit(upload, file_name, repo_id))
+                else:
+                    os.remove(file_name)
+
+        for future in uploads:
+            future.result()
+
+    if pool is not None:
+        model.stop_multi_process_pool(pool)
+
     # time
     end_time = time()
-    print(f"Time taken = {end_time-start_time} seconds")
\ No newline at end of file
+    print(f"Time taken = {end_time-start_time} seconds")
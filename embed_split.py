@@ -1,21 +1,26 @@
 # Import required libraries
 import os
-from glob import glob
 
 import pandas as pd
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 import numpy as np
 
+from batching import encode_bucketed
+from dedup import encode_unique
+from shard_manifest import shard_files
+
 # Define the embedding model
 model = SentenceTransformer("mixedbread-ai/mxbai-embed-large-v1")
 
 # declare batch size
 BATCH_SIZE = 120
 
-# Split metadata
-split_metadata_files = glob("crossref_metadata_split/*.parquet")
-split_metadata_files.sort()
+# Padded tokens per batch, rows are bucketed by length to fill it
+MAX_BATCH_TOKENS = BATCH_SIZE * model.max_seq_length
+
+# Split metadata, in the order of the manifest written by consolidate.py
+split_metadata_files = shard_files("crossref_metadata_split")
 
 # Folder to save files in
 embedding_folder = "crossref_embedding_split"
@@ -27,12 +32,12 @@ for metadata_file in tqdm(split_metadata_files):
     df = pd.read_parquet(metadata_file)
 
     # Calculate the embeddings for text and paragraphs
-    df["vector"] = model.encode(
+    # Rows sharing an abstract get the vector of its one embedding
+    vectors, _ = encode_unique(
+        lambda texts: encode_bucketed(model, texts, MAX_BATCH_TOKENS, show_progress_bar=True),
         df["abstract"].tolist(),
-        batch_size=BATCH_SIZE,
-        show_progress_bar=True,
-        convert_to_numpy=True,
-    ).tolist()
+    )
+    df["vector"] = vectors.tolist()
     
     # Convert lists back to numpy arrays with the correct dtype
     df["vector"] = df["vector"].apply(
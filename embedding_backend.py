@@ -0,0 +1,112 @@
+# Import required libraries
+import numpy as np
+
+################################################################################
+# Query embedding backends
+# Every backend offers the same calls: embed_binary returns the packed 1024 bit
+# (ubinary) vector the collection is searched with, embed_float the normalized
+# float embedding used for rescoring. The _batch versions take a list of texts
+# and answer them with one call.
+
+# Model to use for embedding
+model_name = "mixedbread-ai/mxbai-embed-large-v1"
+
+# Dynamically int8 quantized ONNX export of the model, from its Hugging Face repo
+quantized_onnx_file = "onnx/model_quantized.onnx"
+
+
+# Function to pack a float embedding into a binary vector, one bit per dimension
+def dense_to_binary(dense_vector: np.ndarray) -> bytes:
+    return np.packbits(np.where(dense_vector >= 0, 1, 0)).tobytes()
+
+
+# Function to load the model with sentence-transformers
+# With an onnx file the model runs on ONNX Runtime on the CPU, with its own
+# thread pool of the given size, otherwise on PyTorch.
+def load_model(name: str = model_name, onnx_file: str | None = None, threads: int | None = None, device: str = "cpu"):
+    # Heavy, and only needed by the local backend and the ingestion scripts
+    from sentence_transformers import SentenceTransformer
+
+    if onnx_file is None:
+        return SentenceTransformer(name, device=device)
+
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if threads:
+        session_options.intra_op_num_threads = threads
+
+    return SentenceTransformer(
+        name,
+        device="cpu",
+        backend="onnx",
+        model_kwargs={"file_name": onnx_file, "provider": "CPUExecutionProvider", "session_options": session_options},
+    )
+
+
+################################################################################
+
+
+class MixedbreadBackend:
+    def __init__(self, api_key: str):
+        from mixedbread import Mixedbread
+
+        self.client = Mixedbread(api_key=api_key)
+
+    def _embed(self, texts: list[str], encoding_format: str) -> list:
+        # Call the MixedBread.ai API to generate the embeddings
+        result = self.client.embed(
+            model=model_name,
+            input=texts,
+            normalized=True,
+            encoding_format=encoding_format,
+            dimensions=1024,
+        )
+
+        # In the order of the texts
+        return [item.embedding for item in sorted(result.data, key=lambda item: item.index)]
+
+    def embed_binary_batch(self, texts: list[str]) -> list[bytes]:
+        # Convert every embedding to a numpy array of uint8 encoding and then to bytes
+        return [np.array(embedding, dtype=np.uint8).tobytes() for embedding in self._embed(texts, "ubinary")]
+
+    def embed_float_batch(self, texts: list[str]) -> np.ndarray:
+        return np.array(self._embed(texts, "float"), dtype=np.float32)
+
+    def embed_binary(self, text: str) -> bytes:
+        return self.embed_binary_batch([text])[0]
+
+    def embed_float(self, text: str) -> np.ndarray:
+        return self.embed_float_batch([text])[0]
+
+
+class LocalBackend:
+    def __init__(self, onnx_file: str | None = quantized_onnx_file, threads: int | None = None):
+        self.model = load_model(model_name, onnx_file=onnx_file, threads=threads)
+
+    def embed_float_batch(self, texts: list[str]) -> np.ndarray:
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    # Same bits as the vectors in the collection, which are thresholded at zero
+    def embed_binary_batch(self, texts: list[str]) -> list[bytes]:
+        return [dense_to_binary(embedding) for embedding in self.embed_float_batch(texts)]
+
+    def embed_float(self, text: str) -> np.ndarray:
+        return self.embed_float_batch([text])[0]
+
+    def embed_binary(self, text: str) -> bytes:
+        return self.embed_binary_batch([text])[0]
+
+
+################################################################################
+# Function to create the backend selected in the config
+def create_embedding_backend(
+    name: str = "mixedbread", api_key: str | None = None, onnx_file: str | None = quantized_onnx_file, threads: int | None = None
+):
+    if name == "mixedbread":
+        return MixedbreadBackend(api_key)
+
+    if name == "local":
+        return LocalBackend(onnx_file, threads)
+
+    raise ValueError(f"Unknown embedding backend: {name}")
@@ -0,0 +1,112 @@
+# Import required libraries
+import hashlib
+import os
+import sqlite3
+from time import time
+
+################################################################################
+# Manifest of processed input files
+# Records, for every input file, its size, mtime and content hash together with
+# the output it produced and the number of rows in it. A rerun only has to
+# process files that are new, changed or failed last time.
+
+
+# Function to describe a file by size and modification time, cheap to compute
+def file_stat(path: str) -> tuple[int, float]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+# Function to hash the content of a file
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+################################################################################
+
+
+class FileManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                input TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                hash TEXT,
+                output TEXT,
+                rows INTEGER,
+                error TEXT,
+                processed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files WHERE error IS NULL").fetchone()[0]
+
+    # Function to check whether a file was processed and has not changed since
+    def is_done(self, path: str) -> bool:
+        entry = self.connection.execute(
+            "SELECT size, mtime, hash, output FROM files WHERE input = ? AND error IS NULL", (path,)
+        ).fetchone()
+
+        if entry is None:
+            return False
+
+        size, mtime, hash, output = entry
+
+        # The output may have been deleted since
+        if output is None or not os.path.exists(output):
+            return False
+
+        current_size, current_mtime = file_stat(path)
+
+        if current_size != size:
+            return False
+
+        if current_mtime == mtime:
+            return True
+
+        # Touched but maybe not changed, the hash decides
+        if file_hash(path) != hash:
+            return False
+
+        self.connection.execute("UPDATE files SET mtime = ? WHERE input = ?", (current_mtime, path))
+        self.connection.commit()
+        return True
+
+    # Function to record a processed file
+    def record(self, path: str, size: int, mtime: float, hash: str, output: str, rows: int):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, NULL, ?)",
+            (path, size, mtime, hash, output, rows, time()),
+        )
+        self.connection.commit()
+
+    # Function to record a file that failed, so it is retried on the next run
+    def record_failure(self, path: str, size: int, mtime: float, error: str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL, NULL, ?, ?)",
+            (path, size, mtime, error, time()),
+        )
+        self.connection.commit()
+
+    # Function to list the files that failed on their last run
+    def failures(self) -> list[tuple[str, str]]:
+        return self.connection.execute("SELECT input, error FROM files WHERE error IS NOT NULL").fetchall()
+
+    # Function to count the rows produced by all processed files
+    def total_rows(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(rows), 0) FROM files WHERE error IS NULL").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,211 @@
+# Import required libraries
+import json
+import os
+from time import sleep, time
+
+import requests
+
+################################################################################
+# Orchestrates Milvus bulk import jobs over many shards
+# https://milvus.io/docs/import-data.md
+#
+# Shards are split into several import jobs that run concurrently, up to a
+# limit. Job state is saved to disk after every change, so a crashed run can
+# be resumed: running jobs are polled again, finished shards are skipped and
+# failed shards are retried on their own. Every run gets max_attempts per shard,
+# so a rerun retries the shards an earlier run gave up on.
+# Milvus does not deduplicate primary keys, so a shard is only submitted again
+# once Milvus reports its job as Failed, which imports none of its rows, or no
+# longer knows the job. An error while polling keeps the shard running and it
+# is polled again, as the job may still finish. After max_poll_failures errors
+# in a row the run stops, with the shard still running in the saved state.
+
+# Shard states
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class ImportOrchestrator:
+    def __init__(
+        self,
+        collection_name: str,
+        files: list[str],
+        state_path: str,
+        base_url: str = "http://localhost:19530",
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        poll_interval: float = 10,
+        max_poll_failures: int = 30,
+    ):
+        self.collection_name = collection_name
+        self.state_path = state_path
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_failures = max_poll_failures
+
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+
+        # Resume from the saved state when it belongs to this collection
+        saved = self.load_state(state_path)
+        if saved is not None and saved["collection"] == collection_name:
+            self.shards = saved["shards"]
+            print(f"Resuming import into '{collection_name}' from {state_path}")
+
+            # Shards that ran out of attempts last time get a new budget
+            for shard in self.shards.values():
+                if shard["state"] == FAILED:
+                    shard.update(state=PENDING, attempts=0)
+                shard["poll_failures"] = 0
+        else:
+            self.shards = {}
+
+        # Shards not seen before start as pending
+        for file in files:
+            self.shards.setdefault(file, {"state": PENDING, "job_id": None, "attempts": 0, "rows": 0, "error": None})
+
+        self.save_state()
+
+    # Function to read a saved state, None if there is none
+    @staticmethod
+    def load_state(state_path: str) -> dict | None:
+        if not os.path.exists(state_path):
+            return None
+
+        with open(state_path) as file:
+            return json.load(file)
+
+    def save_state(self):
+        # Write to a temporary file first, so a crash never leaves a torn state file
+        temporary_path = f"{self.state_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"collection": self.collection_name, "shards": self.shards}, file, indent=2)
+        os.replace(temporary_path, self.state_path)
+
+    def _post(self, path: str, payload: dict) -> dict:
+        response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=30)
+        response.raise_for_status()
+        response_json = response.json()
+
+        # The REST API reports errors in the body with a non zero code
+        if response_json.get("code", 0) != 0:
+            raise RuntimeError(f"{path} failed: {response_json}")
+
+        return response_json["data"]
+
+    # Function to start an import job for one shard
+    def _submit(self, file: str):
+        shard = self.shards[file]
+        shard["attempts"] += 1
+
+        try:
+            data = self._post(
+                "/v2/vectordb/jobs/import/create",
+                {"files": [[file]], "collectionName": self.collection_name},
+            )
+            shard.update(state=RUNNING, job_id=data["jobId"], error=None, poll_failures=0, started_at=time())
+            print(f"Submitted {file} as job {shard['job_id']} (attempt {shard['attempts']}).")
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            shard.update(state=FAILED, error=str(e))
+            print(f"Could not submit {file}: {e}")
+
+        # Save the job id at once, a crash before the next save would submit the shard again
+        self.save_state()
+
+    # Function to check on the job of a running shard
+    def _poll(self, file: str):
+        shard = self.shards[file]
+
+        try:
+            data = self._post("/v2/vectordb/jobs/import/get_progress", {"jobId": f"{shard['job_id']}"})
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            # Milvus may have forgotten the job, e.g. after a restart, then none of its rows are in
+            if isinstance(e, RuntimeError) and self.job_not_found(str(e)):
+                shard.update(state=FAILED, error=str(e))
+                print(f"Import job of {file} no longer exists: {e}")
+                return
+
+            # Otherwise the job may still be running, keep polling it
+            shard["poll_failures"] = shard.get("poll_failures", 0) + 1
+            shard["error"] = str(e)
+            print(f"Could not poll {file} ({shard['poll_failures']} in a row): {e}")
+
+            if shard["poll_failures"] >= self.max_poll_failures:
+                self.save_state()
+                raise RuntimeError(f"Gave up polling job {shard['job_id']} of {file}, resume once Milvus answers again") from e
+            return
+
+        shard["poll_failures"] = 0
+        state = data.get("state")
+        shard["progress"] = data.get("progress", 0)
+
+        if state == "Completed":
+            shard.update(state=COMPLETED, rows=int(data.get("totalRows") or data.get("importedRows") or 0), error=None, finished_at=time())
+            print(f"Imported {file}: {shard['rows']} rows.")
+
+        elif state == "Failed":
+            shard.update(state=FAILED, error=data.get("reason") or json.dumps(data))
+            print(f"Import of {file} failed: {shard['error']}")
+
+    # Function to tell whether an error of get_progress says the job does not exist
+    @staticmethod
+    def job_not_found(error: str) -> bool:
+        error = error.lower()
+        return "not exist" in error or "not found" in error
+
+    def _count(self, state: str) -> int:
+        return sum(1 for shard in self.shards.values() if shard["state"] == state)
+
+    # Function to run until every shard is imported or has run out of attempts
+    def run(self) -> dict:
+        start_time = time()
+        rows_at_start = sum(shard["rows"] for shard in self.shards.values() if shard["state"] == COMPLETED)
+
+        while True:
+            # Check on running jobs
+            for file, shard in self.shards.items():
+                if shard["state"] == RUNNING:
+                    self._poll(file)
+
+            # Start new jobs up to the concurrency limit
+            for file, shard in self.shards.items():
+                if self._count(RUNNING) >= self.concurrency:
+                    break
+                if shard["state"] == PENDING:
+                    self._submit(file)
+
+            # Retry failed shards individually, submits that just failed included,
+            # before deciding whether anything is left to do
+            for shard in self.shards.values():
+                if shard["state"] == FAILED and shard["attempts"] < self.max_attempts:
+                    shard["state"] = PENDING
+
+            self.save_state()
+
+            # Report progress and throughput
+            rows = sum(shard["rows"] for shard in self.shards.values() if shard["state"] == COMPLETED)
+            elapsed = time() - start_time
+            print(
+                f"Shards: {self._count(COMPLETED)} completed, {self._count(RUNNING)} running, "
+                f"{self._count(PENDING)} pending, {self._count(FAILED)} failed. "
+                f"Throughput: {(rows - rows_at_start) / elapsed if elapsed else 0:.0f} rows/second."
+            )
+
+            if self._count(RUNNING) == 0 and self._count(PENDING) == 0:
+                break
+
+            sleep(self.poll_interval)
+
+        summary = {
+            "completed": self._count(COMPLETED),
+            "failed": [file for file, shard in self.shards.items() if shard["state"] == FAILED],
+            "rows": sum(shard["rows"] for shard in self.shards.values() if shard["state"] == COMPLETED),
+            "seconds": time() - start_time,
+        }
+        summary["rows_per_second"] = (summary["rows"] - rows_at_start) / summary["seconds"] if summary["seconds"] else 0
+
+        return summary
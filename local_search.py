@@ -0,0 +1,276 @@
+# Import required libraries
+import os
+import re
+import sys
+from bisect import bisect_left
+from glob import glob
+from time import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from vectors import VECTOR_BYTES, binary_vectors_to_matrix, hamming_distances
+
+################################################################################
+# Embedded Hamming distance search over the processed parquet shards
+# A zero service alternative to Milvus, with the same search/get interface.
+#
+# Index layout in index_dir. Vectors are stored sorted by year, so a year
+# filter maps to one contiguous slice and other years are never scanned.
+#   vectors.npy    (rows, 128) uint8 sorted by year, memory mapped
+#   years.npy      (rows,) int16 sorted
+#   row_ids.npy    row id (position in the input files) of each sorted position
+#   positions.npy  sorted position of each row id
+#   metadata.arrow display fields in row id order, uncompressed Arrow IPC, memory mapped
+#   doi_order.npy  row ids sorted by DOI, for lookups by DOI
+
+# Fields kept for display
+metadata_fields = ["DOI", "title", "abstract", "author", "month", "year", "URL"]
+
+# Fields kept when the processed shards have them
+optional_fields = ["row_id"]
+
+# Rows scored per step, bounds the temporary memory of a search
+chunk_rows = 1_000_000
+
+
+################################################################################
+# Function to turn a filter expression into an inclusive year range
+# Supports what the app generates: "", "year == N", "year >= N" etc. joined by "and"
+def parse_year_filter(filter: str) -> tuple[int, int]:
+    low, high = -(2**15), 2**15 - 1
+
+    if not filter.strip():
+        return low, high
+
+    for clause in re.split(r"\s+and\s+", filter.strip(), flags=re.IGNORECASE):
+        match = re.fullmatch(r"\(?\s*year\s*(==|>=|<=|>|<)\s*(-?\d+)\s*\)?", clause)
+
+        if match is None:
+            raise ValueError(f"Unsupported filter for local search: {filter}")
+
+        operator, year = match.group(1), int(match.group(2))
+
+        if operator == "==":
+            low, high = max(low, year), min(high, year)
+        elif operator == ">=":
+            low = max(low, year)
+        elif operator == ">":
+            low = max(low, year + 1)
+        elif operator == "<=":
+            high = min(high, year)
+        elif operator == "<":
+            high = min(high, year - 1)
+
+    return low, high
+
+
+################################################################################
+# Function to build a local index from processed parquet files
+
+
+def build_index(files: list[str], index_dir: str, batch_size: int = 100_000):
+    os.makedirs(index_dir, exist_ok=True)
+
+    # First pass: read only the years, to work out the year sorted layout
+    years = np.concatenate(
+        [pq.read_table(file, columns=["year"]).column("year").to_numpy().astype(np.int16) for file in files]
+        or [np.empty(0, dtype=np.int16)]
+    )
+    num_rows = len(years)
+    print(f"Building local index of {num_rows} rows from {len(files)} files")
+
+    # Stable sort keeps the input order within a year
+    row_ids = np.argsort(years, kind="stable")
+    positions = np.empty(num_rows, dtype=np.int64)
+    positions[row_ids] = np.arange(num_rows)
+
+    np.save(f"{index_dir}/years.npy", years[row_ids])
+    np.save(f"{index_dir}/row_ids.npy", row_ids)
+    np.save(f"{index_dir}/positions.npy", positions)
+
+    # Second pass: scatter the vectors to their sorted positions
+    vectors = np.lib.format.open_memmap(
+        f"{index_dir}/vectors.npy", mode="w+", dtype=np.uint8, shape=(num_rows, VECTOR_BYTES)
+    )
+    dois = []
+
+    schema = None
+    writer = None
+    row = 0
+
+    for file in files:
+        print(f"Processing: {file}")
+        parquet_file = pq.ParquetFile(file)
+        fields = metadata_fields + [field for field in optional_fields if field in parquet_file.schema_arrow.names]
+
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=["vector"] + fields):
+            rows = batch.num_rows
+
+            # Vectors go to their year sorted position
+            vectors[positions[row : row + rows]] = binary_vectors_to_matrix(batch.column("vector"))
+
+            # Display fields go to an Arrow IPC file, in input order
+            metadata = pa.RecordBatch.from_arrays([batch.column(field) for field in fields], names=fields)
+            if writer is None:
+                schema = metadata.schema
+                writer = pa.ipc.new_file(f"{index_dir}/metadata.arrow", schema)
+            writer.write_batch(metadata.cast(schema))
+
+            dois.append(batch.column("DOI"))
+            row += rows
+
+    if writer is not None:
+        writer.close()
+
+    vectors.flush()
+
+    # Row ids ordered by DOI, for binary search lookups
+    doi_order = pc.sort_indices(pa.chunked_array(dois, type=pa.string()) if dois else pa.array([], pa.string()))
+    np.save(f"{index_dir}/doi_order.npy", doi_order.to_numpy().astype(np.int64))
+
+    print(f"Local index written to {index_dir}")
+
+
+################################################################################
+# Local search engine
+
+
+class LocalSearch:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+
+        # Memory map everything, pages are read on demand
+        self.vectors = np.load(f"{index_dir}/vectors.npy", mmap_mode="r")
+        self.years = np.load(f"{index_dir}/years.npy", mmap_mode="r")
+        self.row_ids = np.load(f"{index_dir}/row_ids.npy", mmap_mode="r")
+        self.positions = np.load(f"{index_dir}/positions.npy", mmap_mode="r")
+        self.doi_order = np.load(f"{index_dir}/doi_order.npy", mmap_mode="r")
+        self.metadata = pa.ipc.open_file(pa.memory_map(f"{index_dir}/metadata.arrow")).read_all()
+        self.dois = self.metadata.column("DOI")
+
+    def row_count(self) -> int:
+        return len(self.vectors)
+
+    def generation(self) -> tuple:
+        return self.index_dir, self.row_count(), os.path.getmtime(f"{self.index_dir}/vectors.npy")
+
+    # Function to find the sorted positions holding a year range
+    def year_slice(self, low: int, high: int) -> tuple[int, int]:
+        start, stop = np.searchsorted(self.years, [low, high + 1], side="left")
+        return int(start), int(stop)
+
+    # Function to find the k nearest positions within the year range
+    # With prune, only the slice of positions holding those years is scanned.
+    # Without it every position is scanned and the year is checked afterwards,
+    # which is what a layout that is not sorted by year has to do.
+    def _top_k(self, query: bytes, k: int, low: int, high: int, prune: bool = True):
+        start, stop = self.year_slice(low, high) if prune else (0, self.row_count())
+
+        best_distances = []
+        best_positions = []
+
+        for chunk_start in range(start, stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, stop)
+            positions = np.arange(chunk_start, chunk_stop)
+            matrix = self.vectors[chunk_start:chunk_stop]
+
+            # Post-filter on year when the scan was not pruned
+            if not prune:
+                years = self.years[chunk_start:chunk_stop]
+                mask = (years >= low) & (years <= high)
+                if not mask.any():
+                    continue
+                positions, matrix = positions[mask], matrix[mask]
+
+            distances = hamming_distances(matrix, query)
+
+            # Partial sort, only the k best of this chunk can make the final cut
+            if len(distances) > k:
+                keep = np.argpartition(distances, k - 1)[:k]
+                distances, positions = distances[keep], positions[keep]
+
+            best_distances.append(distances)
+            best_positions.append(positions)
+
+        if not best_distances:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+        distances = np.concatenate(best_distances)
+        positions = np.concatenate(best_positions)
+
+        # Sort by distance, ties by position
+        order = np.lexsort((positions, distances))[:k]
+
+        return distances[order], positions[order]
+
+    # Same interface as MilvusClient.search on one query, returns Milvus shaped hits
+    def search(
+        self, vector: bytes, limit: int, filter: str = "", offset: int = 0, output_fields=None, prune: bool = True
+    ) -> list[dict]:
+        low, high = parse_year_filter(filter)
+
+        distances, positions = self._top_k(vector, offset + limit, low, high, prune=prune)
+        distances, positions = distances[offset:], positions[offset:]
+        rows = [int(self.row_ids[position]) for position in positions]
+
+        hits = [
+            {"id": self.dois[row].as_py(), "distance": int(distance), "entity": {"year": int(self.years[position])}}
+            for distance, position, row in zip(distances, positions, rows)
+        ]
+
+        # Other requested fields come from the metadata
+        extra_fields = [field for field in output_fields or [] if field != "year" and field in self.metadata.column_names]
+        if extra_fields and rows:
+            for hit, record in zip(hits, self.metadata.select(extra_fields).take(rows).to_pylist()):
+                hit["entity"].update(record)
+
+        return hits
+
+    # Function to find the row id of a DOI, None if it is not indexed
+    def _row_of(self, doi: str) -> int | None:
+        position = bisect_left(self.doi_order, doi, key=lambda row: self.dois[int(row)].as_py())
+
+        if position < len(self.doi_order):
+            row = int(self.doi_order[position])
+            if self.dois[row].as_py() == doi:
+                return row
+
+        return None
+
+    # Same interface as MilvusClient.get, returns Milvus shaped rows
+    def get(self, ids: list[str], output_fields: list[str] | None = None) -> list[dict]:
+        output_fields = output_fields or metadata_fields + ["vector"]
+
+        rows = [row for row in map(self._row_of, ids) if row is not None]
+        if not rows:
+            return []
+
+        metadata_columns = [field for field in output_fields if field in self.metadata.column_names]
+        records = self.metadata.select(metadata_columns).take(rows).to_pylist() if metadata_columns else [{} for _ in rows]
+
+        for record, row in zip(records, rows):
+            record["DOI"] = self.dois[row].as_py()
+
+            # Milvus returns binary vectors wrapped in a list
+            if "vector" in output_fields:
+                record["vector"] = [self.vectors[self.positions[row]].tobytes()]
+
+        return records
+
+
+################################################################################
+
+if __name__ == "__main__":
+    # Usage: python local_search.py <processed parquet folder> <index folder>
+    processed_folder = sys.argv[1] if len(sys.argv) > 1 else "/mnt/block_volume/volumes/milvus/processed_data"
+    index_dir = sys.argv[2] if len(sys.argv) > 2 else "local_index"
+
+    files = glob(f"{processed_folder}/*.parquet")
+    files.sort()
+
+    start_time = time()
+    build_index(files, index_dir)
+    print(f"Time taken: {time() - start_time} seconds")
@@ -1,10 +1,19 @@
-from datasets import Dataset
 from time import time
 from multiprocessing import Pool, cpu_count
 from glob import glob
+import gzip
 import os
-import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from file_manifest import FileManifest, file_hash, file_stat
+
+# orjson parses several times faster, fall back to the standard library without it
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 ################################################################################
 
@@ -15,83 +24,144 @@ data_files = glob('/home/mitanshu/Downloads/March 2025 Public Data File from Cro
 processed_folder = 'crossref_metadata'
 os.makedirs(processed_folder, exist_ok=True)
 
-# Process entries
+# Record of the files already processed, so reruns only pick up new or failed ones
+manifest_path = 'metadata_manifest.sqlite'
+
+# Rows per parquet row group, bounds the memory held by each worker
+batch_rows = 50_000
+
+# Columns we care about
+need = ['DOI', 'abstract', 'title', 'author', 'URL', 'created']
+
+# Output layout
+schema = pa.schema([
+    ('DOI', pa.string()),
+    ('abstract', pa.string()),
+    ('title', pa.string()),
+    ('author', pa.list_(pa.string())),
+    ('URL', pa.string()),
+    ('year', pa.int64()),
+    ('month', pa.string()),
+])
+
+# Stream the entries of a file, keeping only complete ones and the fields we need
 def prepare_data(filename):
-    
-    # Load the file
-    df = pd.read_json(filename, lines=True)
-    dataset = Dataset.from_pandas(df)
-    
-    # Filter needs
-    dataset = dataset.filter(lambda row: (bool(row.get('DOI')) and bool(row.get('abstract')) and bool(row.get('title')) and bool(row.get('author')) and bool(row.get('URL')) and bool(row.get('created'))) )
-    
+
+    with gzip.open(filename, 'rb') as file:
+        for line in file:
+
+            row = loads(line)
+
+            # Filter needs
+            if not all(row.get(field) for field in need):
+                continue
+
+            yield {field: row[field] for field in need}
+
+def prepare_metadata(rows):
+    columns = {
+        'DOI': [],
+        'abstract': [],
+        'title': [],
+        'author': [],
+        'URL': [],
+    }
+    created = []
+
+    for row in rows:
+        columns['DOI'].append(row['DOI'])
+        columns['abstract'].append(row['abstract'])
+        columns['URL'].append(row['URL'])
+
+        # Get title text from the list
+        columns['title'].append(row['title'][0])
+
+        # Get author names, made up from their constituents
+        columns['author'].append([
+            str(author.get('family') or "") + ' ' + str(author.get('given') or "") + ' ' + str(author.get('name') or "")
+            for author in row['author']
+        ])
+
+        created.append(row['created']['date-time'])
+
+    # Add month and year, parsed for the whole batch at once
+    timestamps = pc.strptime(pa.array(created, pa.string()), format='%Y-%m-%dT%H:%M:%SZ', unit='s')
+    columns['year'] = pc.year(timestamps).cast(pa.int64())
+    columns['month'] = pc.strftime(timestamps, format='%B')
+
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+def process_file(filename):
+
+    output = f"{processed_folder}/{os.path.basename(filename).replace('.jsonl.gz', '.parquet')}"
+
+    # Describe the input as it was when processing started
+    size, mtime = file_stat(filename)
+    result = {'input': filename, 'size': size, 'mtime': mtime}
+
+    # Write next to the output first, so a crash never leaves a partial file behind
+    temporary = f"{output}.tmp"
+
     try:
-        # Columns we care about
-        need = ['DOI', 'abstract', 'title', 'author', 'URL', 'created']
-        dataset = dataset.select_columns(need)
-        return dataset
+        result['hash'] = file_hash(filename)
+        result['rows'] = 0
+
+        with pq.ParquetWriter(temporary, schema) as writer:
+            rows = []
+
+            for row in prepare_data(filename):
+                rows.append(row)
+
+                if len(rows) == batch_rows:
+                    writer.write_batch(prepare_metadata(rows))
+                    result['rows'] += len(rows)
+                    rows = []
+
+            if rows:
+                writer.write_batch(prepare_metadata(rows))
+                result['rows'] += len(rows)
+
+        os.replace(temporary, output)
+        result['output'] = output
+
     except Exception as e:
-        
+
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
         with open ('metadata.log', 'a') as file:
-            file.write(f"{filename} : {e}")
-        return None
-    
-def prepare_metadata(row):
-    # Get title text from the list
-    row['title'] = row['title'][0]
-    
-    # Get author names
-    authors = []
-    for author in row['author']:
-        
-        # Extract information
-        family = author.get('family')
-        given = author.get('given')
-        name = author.get('name')
-        
-        # Make up the name from its constituents
-        full_name = str(family or "") + ' ' + str(given or "") + ' ' + str(name or "")
-        
-        # Add to list
-        authors.append(full_name)
-        
-    row['author'] = authors
-
-    # Add month and year
-    timestamp = datetime.strptime(row['created']['date-time'], '%Y-%m-%dT%H:%M:%SZ')
-    
-    row['year'] = int(timestamp.strftime('%Y'))
-    row['month'] = timestamp.strftime('%B')
-    
-    return row
-    
-def process_file(filename):
-    
-    # make file usable
-    dataset = prepare_data(filename)
-    
-    if dataset is not None:
-        
-        # Extract info
-        dataset = dataset.map(prepare_metadata, remove_columns=['created'])
-        
-        # Save
-        filename = f"{processed_folder}/{os.path.basename(filename).replace('.jsonl.gz', '.parquet')}"
-        dataset.to_parquet(filename)
-    
-        return filename
-    else:
-        return None
+            file.write(f"{filename} : {e}\n")
+        result['error'] = str(e)
+
+    return result
 
 ################################################################################
 
 if __name__ == '__main__':
-    
+
     start_time = time()
-    
+
+    manifest = FileManifest(manifest_path)
+
+    # Skip the files already processed and unchanged since
+    pending = [filename for filename in data_files if not manifest.is_done(filename)]
+    print(f"{len(data_files) - len(pending)} files already processed, {len(pending)} to go.")
+
+    # Largest files first, so no big file is left running alone at the end
+    pending.sort(key=os.path.getsize, reverse=True)
+
     with Pool(cpu_count()) as pool:
-        pool.map(process_file, data_files)
-        
+        for result in pool.imap_unordered(process_file, pending):
+
+            if 'error' in result:
+                manifest.record_failure(result['input'], result['size'], result['mtime'], result['error'])
+                print(f"Failed: {result['input']}")
+            else:
+                manifest.record(result['input'], result['size'], result['mtime'], result['hash'], result['output'], result['rows'])
+
+    print(f"{len(manifest)} files processed, {manifest.total_rows()} rows in total, {len(manifest.failures())} failed.")
+    manifest.close()
+
     end_time = time()
     print(f"Time taken: {(end_time - start_time)/3600} hours")
 
@@ -0,0 +1,120 @@
+# Import required libraries
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pymilvus import DataType, MilvusClient
+
+from text_cleaning import utf8_bytes
+
+################################################################################
+# Schema of the collection, and checks of the processed shards against it
+# Kept apart from prepare_milvus.py, which connects to Milvus on import, so the
+# preparation scripts can size their fields from the same definition.
+
+
+def build_schema():
+    schema = MilvusClient.create_schema(
+        auto_id=False,
+        enable_dynamic_field=False
+    )
+
+    # Add the fields to the schema
+    # TODO: Find optimal max length for varchar
+    schema.add_field(field_name="DOI", datatype=DataType.VARCHAR, max_length=256, is_primary=True)
+
+    schema.add_field(field_name="vector", datatype=DataType.BINARY_VECTOR, dim=1024)
+
+    schema.add_field(field_name="title", datatype=DataType.VARCHAR, max_length=2048)
+    schema.add_field(field_name="author", datatype=DataType.VARCHAR, max_length=512)
+    schema.add_field(field_name="abstract", datatype=DataType.VARCHAR, max_length=4096)
+    schema.add_field(field_name="month", datatype=DataType.VARCHAR, max_length=16)
+    schema.add_field(field_name="year", datatype=DataType.INT64, max_length=8, is_clustering_key=True)
+    schema.add_field(field_name="URL", datatype=DataType.VARCHAR, max_length=256)
+    # Position of the row in the rescoring store of float embeddings
+    schema.add_field(field_name="row_id", datatype=DataType.INT64)
+
+    return schema
+
+
+# Function to get the maximum UTF-8 bytes of every VARCHAR field
+def varchar_limits(schema) -> dict[str, int]:
+    return {field.name: int(field.params["max_length"]) for field in schema.fields if field.dtype == DataType.VARCHAR}
+
+
+################################################################################
+# Arrow types the import accepts for each field type
+accepted_types = {
+    DataType.VARCHAR: lambda type: pa.types.is_string(type) or pa.types.is_large_string(type),
+    DataType.BINARY_VECTOR: lambda type: pa.types.is_binary(type) or pa.types.is_large_binary(type) or pa.types.is_fixed_size_binary(type),
+    DataType.INT64: pa.types.is_integer,
+}
+
+
+# Function to find the rows of the processed shards that Milvus would reject
+# Checks every field for missing columns, wrong types, missing values, VARCHAR values over
+# their byte limit and binary vectors of the wrong size. Returns a report with
+# the count and a few example DOIs per file and problem.
+def validate_files(files: list[str], schema, batch_size: int = 100_000, examples: int = 5) -> dict:
+    report = {"files": len(files), "rows": 0, "invalid_rows": 0, "problems": {}}
+
+    for file in files:
+        parquet_file = pq.ParquetFile(file)
+        problems = {}
+
+        # Columns the collection needs but the shard does not have
+        names = parquet_file.schema_arrow.names
+        for field in schema.fields:
+            if field.name not in names:
+                problems[f"{field.name}: missing column"] = {"rows": parquet_file.metadata.num_rows, "examples": []}
+
+        columns = [field.name for field in schema.fields if field.name in names]
+
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            report["rows"] += batch.num_rows
+            invalid = None
+
+            for field in schema.fields:
+                if field.name not in columns:
+                    continue
+
+                column = batch.column(field.name)
+                checks = {"missing value": column.is_null().to_numpy(zero_copy_only=False)}
+
+                # A column of the wrong type fails as a whole
+                expected = accepted_types.get(field.dtype)
+                if expected is not None and not expected(column.type):
+                    checks = {f"wrong type {column.type}": np.ones(batch.num_rows, dtype=bool)}
+
+                elif field.dtype == DataType.VARCHAR:
+                    checks[f"over {field.params['max_length']} bytes"] = utf8_bytes(column) > int(field.params["max_length"])
+
+                elif field.dtype == DataType.BINARY_VECTOR:
+                    vector_bytes = int(field.params["dim"]) // 8
+                    checks[f"not {vector_bytes} bytes"] = (
+                        pc.fill_null(pc.binary_length(column), vector_bytes).to_numpy(zero_copy_only=False) != vector_bytes
+                    )
+
+                for reason, failed in checks.items():
+                    if not failed.any():
+                        continue
+
+                    problem = problems.setdefault(f"{field.name}: {reason}", {"rows": 0, "examples": []})
+                    problem["rows"] += int(failed.sum())
+
+                    # A few DOIs to look the rows up by
+                    if "DOI" in columns and len(problem["examples"]) < examples:
+                        dois = batch.column("DOI").filter(failed).to_pylist()
+                        problem["examples"].extend(dois[: examples - len(problem["examples"])])
+
+                    invalid = failed if invalid is None else invalid | failed
+
+            if invalid is not None:
+                report["invalid_rows"] += int(invalid.sum())
+
+        if problems:
+            report["problems"][file] = problems
+
+    report["ok"] = not report["problems"]
+
+    return report
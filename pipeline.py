@@ -0,0 +1,204 @@
+# Import required libraries
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from request_trace import CROSSREF_EMBED, RAW_TEXT, STORED_VECTOR, RequestTrace
+from result_cursor import ResultCursor
+
+################################################################################
+# Async request path of a search
+# extract_doi -> lookup -> (crossref -> embed) -> search -> render, each stage
+# awaited on the event loop instead of holding a worker thread for the whole
+# request. The upstream clients are blocking, so every call runs on a thread
+# pool of its own upstream: a slow upstream can only tie up its own threads,
+# and requests on the other paths keep going.
+# Every stage gets the smaller of its own timeout and what is left of the
+# request deadline, so a request never runs past its deadline.
+
+
+class StageTimeout(TimeoutError):
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"Stage '{stage}' did not finish within {seconds:.2f} seconds")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class AbstractNotFound(LookupError):
+    def __init__(self, doi: str):
+        super().__init__(f"Crossref did not return any abstract for doi: {doi}")
+        self.doi = doi
+
+
+# Time left to finish a request
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires = monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires - monotonic(), 0.0)
+
+
+################################################################################
+# Bounded concurrency limiter for one upstream
+
+
+class Upstream:
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+
+        # Created on first use, the semaphore belongs to the running event loop
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+
+        # Counters
+        self.calls = 0
+        self.timeouts = 0
+
+    # Function to run a blocking call on this upstream within a time budget
+    # Waiting for a free slot counts against the budget. A call that times out
+    # keeps its slot until its thread returns, so the limit holds even for calls
+    # that were given up on.
+    async def call(self, stage: str, timeout: float, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        started = monotonic()
+
+        if timeout <= 0:
+            self.timeouts += 1
+            raise StageTimeout(stage, 0.0)
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            raise StageTimeout(stage, timeout) from None
+
+        self.calls += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        future.add_done_callback(lambda _: self._semaphore.release())
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(timeout - (monotonic() - started), 0.0))
+        except TimeoutError:
+            self.timeouts += 1
+            raise StageTimeout(stage, timeout) from None
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "timeouts": self.timeouts, "concurrency": self.concurrency}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+################################################################################
+# Stage -> upstream it calls
+stage_upstreams = {
+    "lookup": "milvus",
+    "crossref": "crossref",
+    "embed": "embedding",
+    "search": "milvus",
+    "render": "milvus",
+}
+
+
+class SearchPipeline:
+    def __init__(
+        self,
+        extract_doi,
+        lookup,
+        stored_vectors,
+        fetch_abstract,
+        embed_query,
+        search,
+        render,
+        deadline: float = 10,
+        timeouts: dict[str, float] | None = None,
+        concurrency: dict[str, int] | None = None,
+    ):
+        # Stages, all blocking except extract_doi which only runs a regex
+        #   lookup(doi) -> stored rows, stored_vectors(row) -> (vector, query_float)
+        #   fetch_abstract(doi) -> abstract or None, embed_query(text) -> (vector, query_float)
+        #   search follows app.search, render(results, shown_abstracts) -> cards
+        self.extract_doi = extract_doi
+        self.lookup = lookup
+        self.stored_vectors = stored_vectors
+        self.fetch_abstract = fetch_abstract
+        self.embed_query = embed_query
+        self.search = search
+        self.render = render
+
+        # Seconds for a whole request, and at most for each stage
+        self.deadline = deadline
+        self.timeouts = {"lookup": 2, "crossref": 5, "embed": 5, "search": 3, "render": 3, **(timeouts or {})}
+
+        concurrency = {"milvus": 32, "crossref": 16, "embedding": 32, **(concurrency or {})}
+        self.upstreams = {name: Upstream(name, limit) for name, limit in concurrency.items()}
+
+    # Function to run one stage on its upstream, timed on the trace
+    async def _stage(self, trace: RequestTrace, deadline: Deadline, stage: str, fn, *args):
+        timeout = min(self.timeouts[stage], deadline.remaining())
+
+        with trace.stage(stage):
+            return await self.upstreams[stage_upstreams[stage]].call(stage, timeout, fn, *args)
+
+    # Function to run a search from the text typed in, up to its first page
+    # Returns the cards of the first page and the cursor over the rest.
+    async def run(self, input_text: str, limit: int, increment: int, filter: str, trace: RequestTrace) -> tuple[str, ResultCursor]:
+        deadline = Deadline(self.deadline)
+
+        doi = self.extract_doi(input_text)
+
+        # When doi is found in input text
+        if doi:
+            rows = await self._stage(trace, deadline, "lookup", self.lookup, doi)
+
+            # Reuse the stored vector, no external calls needed
+            if rows:
+                trace.path = STORED_VECTOR
+                vector, query_float = self.stored_vectors(rows[0])
+
+            # Embed the abstract Crossref has for it
+            else:
+                trace.path = CROSSREF_EMBED
+
+                abstract = await self._stage(trace, deadline, "crossref", self.fetch_abstract, doi)
+                if not abstract:
+                    raise AbstractNotFound(doi)
+
+                vector, query_float = await self._stage(trace, deadline, "embed", self.embed_query, abstract)
+
+        # When doi is not found in input text, treat input text as abstract
+        else:
+            trace.path = RAW_TEXT
+            vector, query_float = await self._stage(trace, deadline, "embed", self.embed_query, input_text)
+
+        cursor = ResultCursor(vector, filter, page_size=increment, query_float=query_float)
+
+        return await self.next_page(cursor, trace, deadline, size=limit), cursor
+
+    # Function to fetch and render the next page of a cursor
+    async def next_page(self, cursor: ResultCursor, trace: RequestTrace, deadline: Deadline | None = None, size: int | None = None) -> str:
+        deadline = deadline or Deadline(self.deadline)
+
+        # The cursor only moves on once the page is rendered. A stage that times
+        # out leaves its thread running, which must not take the page away from
+        # the next try, so render works on a copy of the abstracts shown.
+        search_results = await self._stage(trace, deadline, "search", cursor.peek_page, self.search, size)
+
+        shown_abstracts = set(cursor.shown_abstracts)
+        cards = await self._stage(trace, deadline, "render", self.render, search_results, shown_abstracts)
+
+        cursor.commit_page(search_results)
+        cursor.shown_abstracts = shown_abstracts
+
+        return cards
+
+    def stats(self) -> dict:
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            upstream.close()
@@ -1,11 +1,16 @@
 # Import required libraries
 from huggingface_hub import snapshot_download # To download vector data
 from glob import glob
-from datasets import load_dataset
-from bs4 import BeautifulSoup
-import re
+from multiprocessing import Pool, cpu_count
+from time import time
 import os
-from tqdm import tqdm
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from milvus_schema import build_schema, varchar_limits
+from text_cleaning import strip_markup, truncate_utf8, utf8_bytes
 ################################################################################
 
 # Download dataset
@@ -14,51 +19,111 @@ repo_type = "dataset"
 local_dir = "/mnt/block_volume/volumes/milvus/embeddings_data"
 allow_patterns = "*.parquet"
 
-# Download the repo
-downloaded_dir = snapshot_download(repo_id=repo_id, repo_type=repo_type, local_dir=local_dir, allow_patterns=allow_patterns, cache_dir='/mnt/block_volume/hf_cache')
-print(f"Downloaded '{repo_id}' at '{downloaded_dir}'")
+# Maximum UTF-8 bytes of every VARCHAR field, straight from the Milvus schema
+max_bytes = varchar_limits(build_schema())
+
+# Fields that can be shortened. Identifiers can not, rows where they do not fit
+# would fail the import and are dropped instead.
+truncated_fields = ['title', 'author', 'abstract', 'month']
+
+# Rows cleaned at once
+batch_rows = 50_000
+
+################################################################################
+
+def prepare(batch, row_offset):
+    columns = {name: batch.column(name) for name in batch.schema.names}
+
+    # Extract abstract text from the JATS markup
+    columns['abstract'] = strip_markup(columns['abstract'])
+
+    # Join authors
+    columns['author'] = pc.binary_join(columns['author'], ", ")
+
+    # Trimming: as many bytes as the VARCHAR field allows, utf-8 characters kept whole
+    for name in truncated_fields:
+        columns[name] = truncate_utf8(columns[name], max_bytes[name])
+
+    # Global row id: position in the concatenation of all shards in sorted order.
+    # Used to find the float embedding of a row in the rescoring store.
+    columns['row_id'] = pa.array(np.arange(row_offset, row_offset + batch.num_rows, dtype=np.int64))
+
+    batch = pa.RecordBatch.from_pydict(columns)
+
+    # Drop rows with identifiers too long for their field
+    fits = np.ones(batch.num_rows, dtype=bool)
+    for name, limit in max_bytes.items():
+        if name not in truncated_fields and name in columns:
+            fits &= utf8_bytes(columns[name]) <= limit
+
+    if not fits.all():
+        print(f"Dropping {int((~fits).sum())} rows with a DOI or URL over the field size")
+        batch = batch.filter(pa.array(fits))
+
+    return batch
+
+def process_file(embedding_file, row_offset, processed_folder):
 
-# Gather files from the folder
-embedding_files = glob(f'{downloaded_dir}/data/*.parquet')
-embedding_files.sort()
+    start_time = time()
 
-# Create directory to save processed data
-processed_folder = f"{downloaded_dir}/processed_data"
-os.makedirs(processed_folder, exist_ok=True)
+    output = f"{processed_folder}/{os.path.basename(embedding_file)}"
+
+    # Write next to the output first, so a crash never leaves a partial file behind
+    temporary = f"{output}.tmp"
+
+    writer = None
+    for batch in pq.ParquetFile(embedding_file).iter_batches(batch_size=batch_rows):
+        prepared = prepare(batch, row_offset)
+
+        # Row ids count the input rows, dropped ones included
+        row_offset += batch.num_rows
+
+        if writer is None:
+            writer = pq.ParquetWriter(temporary, prepared.schema)
+        writer.write_batch(prepared)
+
+    if writer is not None:
+        writer.close()
+        os.replace(temporary, output)
+
+    rows = pq.ParquetFile(embedding_file).metadata.num_rows
+    print(f"Processed: {embedding_file}, {rows / (time() - start_time):.0f} rows/second")
+
+    return rows
 
 ################################################################################
 
-def prepare(row):
-    # Extract abstract
-    soup = BeautifulSoup(row['abstract'], 'html.parser')
-    found = soup.find(re.compile(r'\w+:p|p'))
-    row['abstract'] = found.get_text(strip=True) if found else soup.get_text(strip=True)
-    
-    # Trimming: (num of characters) =  (max milvus bytes allowed) / (max bytes per character) for utf-8.
-    # Trim title
-    row['title'] = str(row['title'])
-    if len(row['title']) > 512: # 2048/4
-        row['title'] = row['title'][:509] + '...'
-
-    # Trim authors
-    row['author'] = ", ".join(row['author'])
-    if len(row['author']) > 128: # 512/4
-        row['author'] = row['author'][:125] + '...'
-
-    # Trim abstract
-    row['abstract'] = str(row['abstract'])
-    if len(row['abstract']) > 1024: # 4096/4 
-        row['abstract'] = row['abstract'][:1149] + '...'
-
-    return row
+if __name__ == '__main__':
+
+    start_time = time()
+
+    # Download the repo
+    downloaded_dir = snapshot_download(repo_id=repo_id, repo_type=repo_type, local_dir=local_dir, allow_patterns=allow_patterns, cache_dir='/mnt/block_volume/hf_cache')
+    print(f"Downloaded '{repo_id}' at '{downloaded_dir}'")
+
+    # Gather files from the folder
+    embedding_files = glob(f'{downloaded_dir}/data/*.parquet')
+    embedding_files.sort()
+
+    # Create directory to save processed data
+    processed_folder = f"{downloaded_dir}/processed_data"
+    os.makedirs(processed_folder, exist_ok=True)
+
+    # Row id of the first row of every shard, computed over all shards so that ids
+    # stay the same when only some of them are processed
+    row_offsets = {}
+    row_offset = 0
+    for embedding_file in embedding_files:
+        row_offsets[embedding_file] = row_offset
+        row_offset += pq.ParquetFile(embedding_file).metadata.num_rows
+
+    # One shard per core, largest first so no big shard is left running alone at the end
+    jobs = sorted(embedding_files, key=os.path.getsize, reverse=True)
+
+    with Pool(cpu_count()) as pool:
+        rows = sum(pool.starmap(process_file, [(embedding_file, row_offsets[embedding_file], processed_folder) for embedding_file in jobs]))
+
+    end_time = time()
+    print(f"Processed {rows} rows in {end_time - start_time:.0f} seconds, {rows / (end_time - start_time):.0f} rows/second")
 
 ################################################################################
-for embedding_file in tqdm(embedding_files[6:]):
-    
-    print(f"Processing: {embedding_file}")
-    
-    dataset = load_dataset("parquet", data_files=embedding_file, split='train', cache_dir='/mnt/block_volume/hf_cache')
-                    
-    dataset = dataset.map(prepare, num_proc=4)
-    
-    dataset.to_parquet(f"{processed_folder}/{os.path.basename(embedding_file)}")
\ No newline at end of file
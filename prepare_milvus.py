@@ -1,194 +1,368 @@
 # Import required libraries
-from pymilvus import MilvusClient, DataType 
-import requests
-from time import sleep
+from pymilvus import MilvusClient
+from dotenv import dotenv_values
+import pyarrow.parquet as pq
+from time import sleep, strftime, time
 from glob import glob
+import argparse
+import json
+import os
+
+from doi_manifest import DOIManifest, row_hashes
+from import_jobs import ImportOrchestrator
+from milvus_schema import build_schema, validate_files
+from shard_manifest import load_shard_manifest, missing_shards
+
+################################################################################
+# Serving always goes through this alias. Every full rebuild loads a new
+# collection behind the scenes and only then points the alias at it, so the
+# app never sees a half-loaded collection.
+alias = "crossref"
+
+# Define client
+client = MilvusClient("http://localhost:19530")
 
 ################################################################################
 # Gather files
 # TODO: /mnt/block_volume/volumes/milvus is mapped to /var/lib/milvus/. make below better
-files = glob('/mnt/block_volume/volumes/milvus/processed_data/*.parquet')
-files = [ ["/var/lib/milvus/processed_data/" + i.split('/')[-1]] for i in files ]
+host_folder = '/mnt/block_volume/volumes/milvus/processed_data'
+container_folder = '/var/lib/milvus/processed_data'
+
+host_files = glob(f'{host_folder}/*.parquet')
+host_files.sort()
 
 ################################################################################
 # Create collection
-# Define client
-client = MilvusClient("http://localhost:19530")
 
-# Drop any of the pre-existing collections
-# Need to drop it because otherwise milvus does not check for (and keeps)
-# duplicate records
-client.drop_collection(
-    collection_name="crossref"
-)
-
-# Dataset schema
-schema = MilvusClient.create_schema(
-    auto_id=False,
-    enable_dynamic_field=False
-)
-
-# Add the fields to the schema
-# TODO: Find optimal max length for varchar
-schema.add_field(field_name="DOI", datatype=DataType.VARCHAR, max_length=256, is_primary=True)
-
-schema.add_field(field_name="vector", datatype=DataType.BINARY_VECTOR, dim=1024)
-
-schema.add_field(field_name="title", datatype=DataType.VARCHAR, max_length=2048)
-schema.add_field(field_name="author", datatype=DataType.VARCHAR, max_length=512)
-schema.add_field(field_name="abstract", datatype=DataType.VARCHAR, max_length=4096)
-schema.add_field(field_name="month", datatype=DataType.VARCHAR, max_length=16)
-schema.add_field(field_name="year", datatype=DataType.INT64, max_length=8, is_clustering_key=True)
-schema.add_field(field_name="URL", datatype=DataType.VARCHAR, max_length=256)
-
-print("Issues with schema: ", schema.verify())
-
-# Create a collection
-client.create_collection(
-    collection_name="crossref",
-    schema=schema,
-    properties={ "mmap.enabled": "true" }
-)
 
-################################################################################
-# Create index
-
-# Set up the index parameters
-index_params = MilvusClient.prepare_index_params()
-
-# Add an index on the vector field.
-index_params.add_index(
-        field_name="vector",
-        metric_type="HAMMING",
-        index_type="BIN_IVF_FLAT",
-        index_name="vector_index",
-        params={ "nlist": 128}
+def create_collection(collection_name):
+    schema = build_schema()
+    print("Issues with schema: ", schema.verify())
+
+    # Create a collection
+    client.create_collection(
+        collection_name=collection_name,
+        schema=schema,
+        properties={ "mmap.enabled": "true" }
+    )
+
+    ############################################################################
+    # Create index
+
+    # Set up the index parameters
+    index_params = MilvusClient.prepare_index_params()
+
+    # Add an index on the vector field.
+    index_params.add_index(
+            field_name="vector",
+            metric_type="HAMMING",
+            index_type="BIN_IVF_FLAT",
+            index_name="vector_index",
+            params={ "nlist": 128}
+        )
+
+    print("Creating Index file.")
+
+    # Create an index file
+    res = client.create_index(
+        collection_name=collection_name,
+        index_params=index_params,
+        sync=True # Wait for index creation to complete before returning.
+    )
+
+    print(res)
+
+    print("Listing indexes.")
+
+    # List indexes
+    res = client.list_indexes(
+        collection_name=collection_name
+    )
+
+    print(res)
+
+    print("Describing Index.")
+
+    # Describe index
+    res = client.describe_index(
+        collection_name=collection_name,
+        index_name="vector_index"
+    )
+
+    print(res)
+
+    ############################################################################
+
+    # Load the collection
+
+    print("Loading Collection")
+
+    client.load_collection(
+        collection_name=collection_name,
+        replica_number=1 # Number of replicas to create on query nodes.
+    )
+
+    res = client.get_load_state(
+        collection_name=collection_name
     )
 
-print("Creating Index file.")
+    print("Collection load state:")
+    print(res)
+
+################################################################################
+# Clustering compaction
+# Rewrites the segments so each holds a narrow range of years (the clustering
+# key). Together with queryNode.enableSegmentPrune in user.yaml, filtered
+# searches then skip the segments of other years instead of post-filtering.
+
+
+def compact(collection_name, poll_interval=10, max_wait=6 * 3600):
+
+    print("Starting clustering compaction on year.")
+
+    compaction_id = client.compact(
+        collection_name=collection_name,
+        is_clustering=True
+    )
 
-# Create an index file
-res = client.create_index(
-    collection_name="crossref",
-    index_params=index_params,
-    sync=True # Wait for index creation to complete before returning. 
-)
+    started = time()
+    executing = False
 
-print(res)
+    while True:
 
-print("Listing indexes.")
+        # Sleep a bit
+        print(f"Sleeping for {poll_interval} seconds")
+        sleep(poll_interval)
 
-# List indexes
-res = client.list_indexes(
-    collection_name="crossref"
-)
+        compaction_state = client.get_compaction_state(compaction_id)
+        print(f"Compaction: {compaction_state}.")
 
-print(res)
+        if compaction_state == 'Completed':
+            break
 
-print("Describing Index.")
+        # Stop instead of polling forever when the compaction did not go through.
+        # Milvus forgets a compaction that failed or was cancelled, its state
+        # then falls back to undefined.
+        if compaction_state in ('Failed', 'Timeout', 'Cancelled') or (executing and compaction_state == 'UndefiedState'):
+            raise RuntimeError(f"Clustering compaction {compaction_id} of '{collection_name}' ended in state {compaction_state}.")
 
-# Describe index
-res = client.describe_index(
-    collection_name="crossref",
-    index_name="vector_index"
-)
+        executing = executing or compaction_state == 'Executing'
 
-print(res)
+        if time() - started > max_wait:
+            raise TimeoutError(f"Clustering compaction {compaction_id} of '{collection_name}' did not complete within {max_wait} seconds.")
 
 ################################################################################
+# Alias swap
 
-# Load the collection
 
-print("Loading Collection")
+# Function to find the collection currently behind the alias, if any
+def aliased_collection():
+    try:
+        return client.describe_alias(alias=alias)["collection_name"]
+    except Exception:
+        return None
 
-client.load_collection(
-    collection_name="crossref",
-    replica_number=1 # Number of replicas to create on query nodes. 
-)
 
-res = client.get_load_state(
-    collection_name="crossref"
-)
+def swap_alias(collection_name):
+    previous = aliased_collection()
 
-print("Collection load state:")
-print(res)
+    if previous is None and client.has_collection(collection_name=alias):
+        # A collection created before aliases were used holds the name.
+        # It has to go before the alias can take its place.
+        print(f"Dropping legacy collection '{alias}' to make room for the alias.")
+        client.drop_collection(collection_name=alias)
 
-################################################################################ 
-# Create import job
-# https://milvus.io/docs/import-data.md
+    if previous is None:
+        client.create_alias(collection_name=collection_name, alias=alias)
+    else:
+        client.alter_alias(collection_name=collection_name, alias=alias)
 
-# Define the API endpoint
-job_url = "http://localhost:19530/v2/vectordb/jobs/import/create"
+    print(f"Alias '{alias}' now points to '{collection_name}'.")
 
-# Define the headers
-headers = {
-    "Content-Type": "application/json"
-}
+    # The previous collection is no longer served
+    if previous is not None and previous != collection_name:
+        print(f"Dropping previous collection '{previous}'.")
+        client.drop_collection(collection_name=previous)
+
+################################################################################
+# Manifest
+
+
+# Function to iterate over the processed shards in batches
+def iterate_batches(files, columns=None, batch_size=10_000):
+    for file in files:
+        print(f"Reading: {file}")
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch
 
-# Define the data payload
-job_url_data = {
-    "files": files,
-    "collectionName": "crossref"
-}
 
-# Make the POST request
-job_response = requests.post(job_url, headers=headers, json=job_url_data)
-job_json = job_response.json()
+# Function to record every row of the processed shards, after a full rebuild
+def rebuild_manifest(manifest):
+    manifest.reset()
 
-# Print the response
-print("Job details:")
-print(job_response.status_code)
-print(job_json)
+    for batch in iterate_batches(host_files):
+        manifest.record(batch.column("DOI").to_pylist(), row_hashes(batch))
 
-# Extract jobId
-job_id = job_json['data']['jobId']
+    print(f"Manifest holds {len(manifest)} DOIs.")
 
-# Periodically check on import status
-progress_url = "http://localhost:19530/v2/vectordb/jobs/import/get_progress"
+################################################################################
+# Full rebuild: new collection, bulk import, then swap the alias
 
-progress_url_data = {
-    "jobId": f"{job_id}"
-}
 
-while True:
+def full_rebuild(manifest, state_path, concurrency=4):
+    # A rebuild that crashed during the import left its state behind
+    state = ImportOrchestrator.load_state(state_path)
 
-    print('*'*80)
+    if state is not None and client.has_collection(collection_name=state["collection"]):
+        collection_name = state["collection"]
+        print(f"Resuming collection '{collection_name}'.")
+    else:
+        # Milvus does not check for (and keeps) duplicate primary keys, so every
+        # rebuild starts from an empty collection
+        collection_name = f"{alias}_{strftime('%Y%m%d_%H%M%S')}"
+        print(f"Building collection '{collection_name}'.")
 
-    # Sleep a bit
-    seconds = 10
-    print(f"Sleeping for {seconds} seconds")
-    sleep(seconds)
+        create_collection(collection_name)
 
-    
-    # Make the POST request
-    progress_response = requests.post(progress_url, headers=headers, json=progress_url_data)
+    # One import job per shard, several running at once
+    # https://milvus.io/docs/import-data.md
+    files = [ f"{container_folder}/{os.path.basename(i)}" for i in host_files ]
+    orchestrator = ImportOrchestrator(collection_name, files, state_path, concurrency=concurrency)
+    summary = orchestrator.run()
 
-    progress_json = progress_response.json()
-    # print(progress_json)
+    print(f"Imported {summary['rows']} rows at {summary['rows_per_second']:.0f} rows/second.")
 
-    progress_percent = progress_json['data']['progress']
-    progress_state = progress_json['data']['state']
+    # Keep the state, so the next run resumes the failed shards only
+    if summary["failed"]:
+        print(f"Shards failed after all attempts: {summary['failed']}")
+        print(f"Run again to retry them, state is kept in {state_path}.")
+        exit(1)
 
-    if progress_state == 'Pending' or progress_state == 'Importing':
+    compact(collection_name)
 
-        print(f"Job: {progress_state}.")
-        print(f"Finised: {progress_percent}%.")
+    swap_alias(collection_name)
 
-    elif progress_state == 'Completed':
+    rebuild_manifest(manifest)
 
-        print(f"Job: {progress_state}.")
-        print(f"Imported {progress_json['data']['totalRows']} rows.")
+    # The import is done, the next rebuild starts afresh
+    os.remove(state_path)
 
-        break
+################################################################################
+# Incremental update: upsert new or changed rows, delete retracted ones
 
-    elif progress_state == 'Failed':
 
-        print(f"Job: {progress_state}.")
-        print(progress_json)
+def incremental_update(manifest, batch_size=1_000):
+    collection_name = aliased_collection()
 
-        print("Exiting...")
+    if collection_name is None:
+        print(f"No collection behind alias '{alias}', run a full rebuild first.")
         exit()
 
+    print(f"Updating collection '{collection_name}'.")
+
+    # Only the columns the collection knows about
+    schema_fields = [field.name for field in build_schema().fields]
+
+    manifest.begin()
+
+    upserted = 0
+    unchanged = 0
+
+    for batch in iterate_batches(host_files, batch_size=batch_size):
+        dois = batch.column("DOI").to_pylist()
+        hashes = row_hashes(batch)
+
+        # Only rows that are new or whose content changed
+        changed = manifest.diff(dois, hashes)
+
+        if changed:
+            rows = batch.select(schema_fields).take(changed).to_pylist()
+            client.upsert(collection_name=collection_name, data=rows)
+
+        # Record after the write, so a crash never marks unwritten rows as done
+        manifest.record(dois, hashes)
+
+        upserted += len(changed)
+        unchanged += len(dois) - len(changed)
+
+    print(f"Upserted {upserted} rows, {unchanged} rows unchanged.")
+
+    # DOIs that are no longer in the snapshot
+    retracted = manifest.retracted()
+
+    for start in range(0, len(retracted), batch_size):
+        dois = retracted[start:start + batch_size]
+        client.delete(collection_name=collection_name, ids=dois)
+        manifest.forget(dois)
+
+    print(f"Deleted {len(retracted)} retracted rows.")
+
+    client.flush(collection_name=collection_name)
+
+    compact(collection_name)
+
+################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load the processed shards into Milvus")
+    parser.add_argument("--mode", choices=["full", "incremental"], default="full")
+    parser.add_argument("--manifest", default="doi_manifest.sqlite")
+    parser.add_argument("--import-state", default="import_state.json")
+    parser.add_argument("--import-concurrency", type=int, default=4)
+    parser.add_argument("--validation-report", default="validation_report.json")
+    parser.add_argument("--skip-validation", action="store_true")
+    parser.add_argument("--shard-manifest", default="", help="shards.json written by consolidate.py, to check that no shard is missing")
+    args = parser.parse_args()
+
+    # Row ids are positions in the processed shards. An incremental update keeps
+    # the row id of unchanged rows, which no longer matches their position in a
+    # rescoring store rebuilt from the refreshed shards.
+    if args.mode == "incremental" and dotenv_values(".env").get("RESCORE_STORE_DIR"):
+        print("Rescoring is configured (RESCORE_STORE_DIR), incremental updates would leave row ids pointing at the wrong vectors.")
+        print("Run a full rebuild, then rebuild the rescoring store from the same shards.")
+        exit(1)
+
+    # Every shard consolidate.py wrote must have made it through embedding and preparation
+    if args.shard_manifest:
+        shard_manifest = load_shard_manifest(args.shard_manifest)
+
+        missing = missing_shards(shard_manifest, host_files)
+        if missing:
+            print(f"Shards in {args.shard_manifest} without a processed file: {missing}")
+            exit(1)
+
+        # Heaviest shards first, so no large import is left running alone at the end
+        weights = {os.path.basename(shard["file"]): shard["weight"] for shard in shard_manifest["shards"]}
+        host_files.sort(key=lambda file: weights.get(os.path.basename(file), 0), reverse=True)
+
+    # Find rows the import would reject before any job runs
+    if not args.skip_validation:
+        print("Validating processed shards against the schema.")
+        report = validate_files(host_files, build_schema())
+
+        with open(args.validation_report, "w") as file:
+            json.dump(report, file, indent=2)
+
+        print(f"Validated {report['rows']} rows in {report['files']} files, {report['invalid_rows']} invalid.")
+
+        if not report["ok"]:
+            for file, problems in report["problems"].items():
+                for problem, details in problems.items():
+                    print(f"{file}: {problem} in {details['rows']} rows, e.g. {details['examples']}")
+
+            print(f"Fix the shards before importing, the full report is in {args.validation_report}.")
+            exit(1)
+
+    manifest = DOIManifest(args.manifest)
+
+    if args.mode == "full":
+        full_rebuild(manifest, args.import_state, args.import_concurrency)
+    else:
+        incremental_update(manifest)
+
+    manifest.close()
+
 ################################################################################
 
 
@@ -0,0 +1,125 @@
+# Import required libraries
+import json
+import sys
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from time import perf_counter
+
+################################################################################
+# Paths a query can take through predict
+STORED_VECTOR = "stored_vector"  # DOI already indexed, reuse its vector
+CROSSREF_EMBED = "crossref_embed"  # DOI not indexed, fetch abstract and embed it
+RAW_TEXT = "raw_text"  # No DOI, embed the input text
+
+
+################################################################################
+# Per request record of the path taken and time spent in each stage
+
+
+class RequestTrace:
+    def __init__(self, name: str = "predict"):
+        self.name = name
+        self.path = None
+        self.timings = {}
+        self.started = perf_counter()
+        self.total = None
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        # Time a stage, accumulating if the same stage runs more than once
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage_name] = self.timings.get(stage_name, 0.0) + perf_counter() - start
+
+    def finish(self):
+        self.total = perf_counter() - self.started
+        return self
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "path": self.path,
+            "total_ms": round((self.total or perf_counter() - self.started) * 1000, 2),
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.timings.items()},
+        }
+
+    def report(self):
+        print(f"Trace: {json.dumps(self.as_dict())}")
+
+
+################################################################################
+# Rolling latency summary per path, to compare how long each path takes
+
+
+class TraceSummary:
+    def __init__(self, window: int = 1000):
+        # path -> latest total latencies in seconds
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, trace: RequestTrace):
+        with self._lock:
+            self._counts[trace.path] += 1
+            self._latencies[trace.path].append(trace.total)
+
+    def stats(self) -> dict:
+        with self._lock:
+            summary = {}
+            for path, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                summary[path] = {
+                    "count": self._counts[path],
+                    "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+                    "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+                    "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+                }
+            return summary
+
+
+################################################################################
+# Periodic report of service statistics
+# Collects the stats() of the registered sources and writes them as one log
+# line every interval, from a background thread, instead of printing on the
+# request path where concurrent requests interleave their output.
+
+
+class StatsReporter:
+    def __init__(self, interval: float = 60):
+        self.interval = interval
+
+        # name -> function returning a JSON serializable dict
+        self.sources = {}
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name: str, stats_fn):
+        self.sources[name] = stats_fn
+
+    def as_dict(self) -> dict:
+        return {name: stats_fn() for name, stats_fn in self.sources.items()}
+
+    def report(self):
+        # One write per report, so lines from other threads never split it
+        sys.stdout.write(f"Stats: {json.dumps(self.as_dict())}\n")
+        sys.stdout.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                sys.stdout.write(f"Stats report failed: {e}\n")
+
+    # Function to report in the background, an interval of 0 disables it
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stats_reporter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
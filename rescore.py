@@ -0,0 +1,162 @@
+# Import required libraries
+import json
+import os
+import sys
+from glob import glob
+from time import time
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from vectors import VECTOR_DIMENSIONS, float_vectors_to_matrix
+
+################################################################################
+# Rescoring of binary search candidates with float embeddings
+# Hamming distance over 1024 bits picks k x R candidates cheaply, then the
+# float query embedding reranks them against compact document vectors kept on
+# disk and indexed by row id.
+#
+# Store layout in store_dir:
+#   vectors.npy  (rows, 1024) int8 or float16, memory mapped, in row id order
+#   ranges.npy   (2, 1024) float32 per dimension min and max, int8 only
+#   store.json   dtype, row count and source files
+#
+# Row ids are positions in the concatenation of the shards sorted by file name,
+# the same order prepare_embeddings.py uses to assign the row_id field.
+
+
+################################################################################
+# Function to scale embeddings to unit length, so dot products are cosine similarities
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+# Function to find the per dimension range used for int8 quantization
+def calibrate_ranges(sample: np.ndarray) -> np.ndarray:
+    return np.stack([sample.min(axis=0), sample.max(axis=0)]).astype(np.float32)
+
+
+# Function to quantize float embeddings to int8 within the calibrated ranges
+def quantize_int8(matrix: np.ndarray, ranges: np.ndarray) -> np.ndarray:
+    low, high = ranges
+    steps = (high - low) / 255
+    steps[steps == 0] = 1
+
+    quantized = np.round((matrix - low) / steps) - 128
+
+    return np.clip(quantized, -128, 127).astype(np.int8)
+
+
+# Function to turn stored vectors back into floats
+def dequantize(stored: np.ndarray, ranges: np.ndarray | None) -> np.ndarray:
+    if ranges is None:
+        return stored.astype(np.float32)
+
+    low, high = ranges
+    steps = (high - low) / 255
+    steps[steps == 0] = 1
+
+    return low + (stored.astype(np.float32) + 128) * steps
+
+
+################################################################################
+# Function to build a rescoring store from float embedding shards
+
+
+def build_store(files: list[str], store_dir: str, dtype: str = "int8", calibration_rows: int = 100_000, batch_size: int = 50_000):
+    os.makedirs(store_dir, exist_ok=True)
+
+    num_rows = sum(pq.ParquetFile(file).metadata.num_rows for file in files)
+    print(f"Building {dtype} rescoring store of {num_rows} rows from {len(files)} files")
+
+    # Calibrate int8 ranges on the first rows
+    ranges = None
+    if dtype == "int8":
+        sample = next(pq.ParquetFile(files[0]).iter_batches(batch_size=calibration_rows, columns=["vector"]))
+        ranges = calibrate_ranges(normalize(float_vectors_to_matrix(sample.column("vector"))))
+        np.save(f"{store_dir}/ranges.npy", ranges)
+
+    vectors = np.lib.format.open_memmap(
+        f"{store_dir}/vectors.npy", mode="w+", dtype=np.dtype(dtype), shape=(num_rows, VECTOR_DIMENSIONS)
+    )
+
+    row = 0
+    for file in files:
+        print(f"Processing: {file}")
+
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=["vector"]):
+            matrix = normalize(float_vectors_to_matrix(batch.column("vector")))
+
+            if dtype == "int8":
+                vectors[row : row + len(matrix)] = quantize_int8(matrix, ranges)
+            else:
+                vectors[row : row + len(matrix)] = matrix.astype(dtype)
+
+            row += len(matrix)
+
+    vectors.flush()
+
+    with open(f"{store_dir}/store.json", "w") as file:
+        json.dump({"dtype": dtype, "rows": num_rows, "files": [os.path.basename(file) for file in files]}, file, indent=2)
+
+    print(f"Rescoring store written to {store_dir}")
+
+
+################################################################################
+# Reranks candidates by the dot product of float embeddings
+
+
+class Rescorer:
+    def __init__(self, vectors: np.ndarray, ranges: np.ndarray | None = None):
+        self.vectors = vectors
+        self.ranges = ranges
+
+    # Function to open a store built by build_store
+    @classmethod
+    def load(cls, store_dir: str):
+        vectors = np.load(f"{store_dir}/vectors.npy", mmap_mode="r")
+        ranges = np.load(f"{store_dir}/ranges.npy") if os.path.exists(f"{store_dir}/ranges.npy") else None
+        return cls(vectors, ranges)
+
+    # Function to get the (approximate) float embeddings of some rows
+    def embeddings(self, row_ids) -> np.ndarray:
+        return dequantize(self.vectors[np.asarray(row_ids, dtype=np.int64)], self.ranges)
+
+    # Function to score rows against a float query, higher is more similar
+    def scores(self, query: np.ndarray, row_ids) -> np.ndarray:
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+
+        if len(row_ids) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        # Read the rows in disk order, then put the scores back in candidate order
+        order = np.argsort(row_ids)
+        stored = self.vectors[row_ids[order]]
+
+        scores = np.empty(len(row_ids), dtype=np.float32)
+        scores[order] = dequantize(stored, self.ranges) @ np.asarray(query, dtype=np.float32)
+
+        return scores
+
+    # Function to reorder candidates by float similarity, returns candidate indices
+    def rerank(self, query: np.ndarray, row_ids) -> np.ndarray:
+        # Stable, so ties keep their Hamming order
+        return np.argsort(-self.scores(query, row_ids), kind="stable")
+
+
+################################################################################
+
+if __name__ == "__main__":
+    # Usage: python rescore.py <float embedding folder> <store folder> [int8|float16]
+    float_folder = sys.argv[1] if len(sys.argv) > 1 else "float_embeddings/data"
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else "rescore_store"
+    dtype = sys.argv[3] if len(sys.argv) > 3 else "int8"
+
+    files = glob(f"{float_folder}/*.parquet")
+    files.sort()
+
+    start_time = time()
+    build_store(files, store_dir, dtype)
+    print(f"Time taken: {time() - start_time} seconds")
@@ -0,0 +1,105 @@
+# Import required libraries
+import threading
+
+################################################################################
+# Milvus rejects searches where offset + limit goes beyond this
+MAX_SEARCH_WINDOW = 16384
+
+
+################################################################################
+# Server side cursor over the results of one search
+# Lives in the session state, so the query vector and filter are only
+# resolved once per search and every "More results" click costs one page.
+
+
+class ResultCursor:
+    def __init__(self, vector: bytes, filter: str = "", page_size: int = 5, prefetch_pages: int = 4, **search_kwargs):
+        # What is being searched, extra keyword arguments are passed on to the search
+        self.vector = vector
+        self.filter = filter
+        self.search_kwargs = search_kwargs
+
+        # How many results to show per click, and how many pages to fetch at once
+        self.page_size = page_size
+        self.prefetch_pages = prefetch_pages
+
+        # Results fetched from the backend but not shown yet
+        self.buffer = []
+
+        # Number of results fetched so far, i.e. the offset of the next fetch
+        self.fetched = 0
+
+        # Number of results handed out so far
+        self.shown = 0
+
+        # Ids already fetched, a reranked search may return some of them again
+        self.seen = set()
+
+        # Whether the backend has no more results to give
+        self.exhausted = False
+
+        # Hashes of the abstracts shown so far, to collapse duplicate papers across pages
+        self.shown_abstracts = set()
+
+        # A fetch given up on by a timeout keeps running, a retry waits for it
+        # and gets the page it fetched instead of fetching past it
+        self._lock = threading.Lock()
+
+    # The lock cannot be copied, Gradio copies session state
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def has_more(self) -> bool:
+        return bool(self.buffer) or not self.exhausted
+
+    # Function to get the next page of results without handing it out
+    # search_fn follows the signature of app.search(vector, limit, filter, offset).
+    # The page stays in the buffer until commit_page, so a page that never makes
+    # it to the user, e.g. because rendering timed out, is not lost.
+    def peek_page(self, search_fn, size: int | None = None) -> list[dict]:
+        with self._lock:
+            return self._peek_page(search_fn, size)
+
+    def _peek_page(self, search_fn, size: int | None = None) -> list[dict]:
+        size = size or self.page_size
+
+        # Over-fetch a few pages when the buffer cannot fill this one
+        if len(self.buffer) < size and not self.exhausted:
+            limit = min(max(size, self.page_size) * self.prefetch_pages, MAX_SEARCH_WINDOW - self.fetched)
+
+            if limit > 0:
+                results = search_fn(self.vector, limit, self.filter, offset=self.fetched, **self.search_kwargs)
+                self.fetched += len(results)
+
+                for result in results:
+                    if result["id"] not in self.seen:
+                        self.seen.add(result["id"])
+                        self.buffer.append(result)
+
+                # A short read means we have reached the end
+                self.exhausted = len(results) < limit
+            else:
+                self.exhausted = True
+
+        return self.buffer[:size]
+
+    # Function to hand out a page returned by peek_page
+    def commit_page(self, page: list[dict]):
+        with self._lock:
+            if self.buffer[: len(page)] == page:
+                self.buffer = self.buffer[len(page) :]
+                self.shown += len(page)
+
+    # Function to get and hand out the next page of results
+    def next_page(self, search_fn, size: int | None = None) -> list[dict]:
+        page = self.peek_page(search_fn, size)
+        self.commit_page(page)
+
+        return page
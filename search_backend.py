@@ -0,0 +1,54 @@
+# Import required libraries
+from pymilvus import MilvusClient
+
+################################################################################
+# Vector search backends
+# Every backend offers the same calls: search, get, row_count and generation.
+# Results are shaped like those of MilvusClient, so callers do not care which
+# backend is in use.
+
+
+class MilvusBackend:
+    def __init__(self, uri: str = "http://localhost:19530", collection_name: str = "crossref"):
+        self.client = MilvusClient(uri)
+        self.collection_name = collection_name
+
+    def search(self, vector: bytes, limit: int, filter: str = "", offset: int = 0, output_fields=None) -> list[dict]:
+        result = self.client.search(
+            collection_name=self.collection_name,  # Collection to search in
+            data=[vector],  # Vector to search for
+            limit=limit,  # Max. number of search results to return
+            output_fields=output_fields or [],  # Output fields to return
+            filter=filter,  # Filter to apply to the search
+            offset=offset,  # Number of results to skip, for pagination
+        )
+
+        # returns a list of dictionaries with id and distance as keys
+        return list(result[0])
+
+    def get(self, ids: list[str], output_fields: list[str] | None = None) -> list[dict]:
+        return self.client.get(collection_name=self.collection_name, ids=ids, output_fields=output_fields)
+
+    def row_count(self) -> int:
+        return self.client.get_collection_stats(collection_name=self.collection_name)["row_count"]
+
+    # Function returning a value that changes whenever the collection does
+    def generation(self) -> tuple:
+        collection_id = self.client.describe_collection(collection_name=self.collection_name)["collection_id"]
+        load_state = self.client.get_load_state(collection_name=self.collection_name)["state"]
+        return collection_id, self.row_count(), str(load_state)
+
+
+################################################################################
+# Function to create the backend selected in the config
+def create_backend(name: str = "milvus", milvus_uri: str = "http://localhost:19530", local_index_dir: str = "local_index"):
+    if name == "milvus":
+        return MilvusBackend(milvus_uri)
+
+    if name == "local":
+        # Only needs numpy and pyarrow, import lazily
+        from local_search import LocalSearch
+
+        return LocalSearch(local_index_dir)
+
+    raise ValueError(f"Unknown search backend: {name}")
@@ -0,0 +1,107 @@
+# Import required libraries
+import threading
+from time import time
+
+from caching import LRUCache
+
+################################################################################
+# Cache of search results keyed on (query vector, filter expression)
+# A cached top-N answers any request that falls inside it, so smaller limits
+# and later pages of the same search do not go back to the vector database.
+
+
+class SearchCache:
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float | None = None,
+        generation_fn=None,
+        check_interval: float = 30,
+    ):
+        # (vector, filter) -> (number of results asked for, results)
+        self.results = LRUCache(
+            max_bytes=max_bytes,
+            ttl=ttl,
+            sizeof=lambda key, value: len(key[0]) + len(key[1]) + len(repr(value[1])),
+        )
+
+        # Function returning something that changes whenever the collection
+        # does, e.g. its id, row count and load state
+        self.generation_fn = generation_fn
+        self.check_interval = check_interval
+        self.generation = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Function to get results for a search, None if they are not cached
+    def get(self, vector: bytes, filter: str, limit: int, offset: int = 0) -> list[dict] | None:
+        self._check_generation()
+
+        entry = self.results.get((vector, filter))
+
+        if entry is not None:
+            requested, results = entry
+
+            # The window is inside the cached prefix, or the cached read was
+            # short so it already holds every result there is
+            if offset + limit <= requested or len(results) < requested:
+                self.hits += 1
+                return results[offset : offset + limit]
+
+        self.misses += 1
+        return None
+
+    # Function to remember results of a search
+    def put(self, vector: bytes, filter: str, limit: int, offset: int, results: list[dict]):
+        self._check_generation()
+
+        key = (vector, filter)
+
+        if offset == 0:
+            requested, cached = limit, results
+        else:
+            # Extend a cached prefix if this page continues it
+            entry = self.results.get(key)
+            if entry is None or entry[0] != offset or len(entry[1]) != offset:
+                return
+            requested, cached = offset + limit, entry[1] + results
+
+        # Keep the longer prefix
+        entry = self.results.get(key)
+        if entry is not None and entry[0] >= requested:
+            return
+
+        self.results.put(key, (requested, cached))
+
+    # Function to drop everything when the collection changes
+    def _check_generation(self):
+        if self.generation_fn is None:
+            return
+
+        with self._lock:
+            if time() - self.checked_at < self.check_interval:
+                return
+            self.checked_at = time()
+
+            generation = self.generation_fn()
+
+            if generation != self.generation:
+                if self.generation is not None:
+                    self.invalidations += 1
+                self.results.clear()
+                self.generation = generation
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
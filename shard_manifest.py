@@ -0,0 +1,57 @@
+# Import required libraries
+import json
+import os
+from glob import glob
+
+################################################################################
+# Manifest of the metadata shards written by consolidate.py
+# Lists every shard with its rows, weight, year range and row groups, in the
+# order they were written. The embed and import steps take their shards from it
+# instead of globbing, so a missing or stray file is noticed before any work.
+
+manifest_name = "shards.json"
+
+
+# Function to write a manifest next to the shards, atomically
+def write_shard_manifest(folder: str, manifest: dict) -> str:
+    path = f"{folder}/{manifest_name}"
+
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+    return path
+
+
+def load_shard_manifest(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+# Function to list the shards of a folder, in manifest order when it has one
+# The manifest may sit anywhere below the folder, a Hugging Face snapshot keeps
+# the shards under data/. Without a manifest, falls back to every parquet file.
+def shard_files(folder: str) -> list[str]:
+    manifests = glob(f"{folder}/**/{manifest_name}", recursive=True)
+
+    if not manifests:
+        files = glob(f"{folder}/**/*.parquet", recursive=True)
+        files.sort()
+        return files
+
+    manifest_path = manifests[0]
+    manifest = load_shard_manifest(manifest_path)
+    files = [os.path.join(os.path.dirname(manifest_path), shard["file"]) for shard in manifest["shards"]]
+
+    missing = [file for file in files if not os.path.exists(file)]
+    if missing:
+        raise FileNotFoundError(f"Shards listed in {manifest_path} are missing: {missing}")
+
+    return files
+
+
+# Function to find the shards of a manifest that have no file among the given ones
+# Files are matched by name, as later steps keep the names but not the folders.
+def missing_shards(manifest: dict, files: list[str]) -> list[str]:
+    names = {os.path.basename(file) for file in files}
+    return [shard["file"] for shard in manifest["shards"] if os.path.basename(shard["file"]) not in names]
@@ -30,6 +30,16 @@ EOF
 
     cat << EOF > user.yaml
 # Extra config to override default milvus.yaml
+# Clustering compaction groups rows into segments by year (the clustering
+# key), and segment pruning lets filtered searches skip segments whose year
+# range does not match the filter.
+queryNode:
+  enableSegmentPrune: true
+dataCoord:
+  compaction:
+    clustering:
+      enable: true
+      autoEnable: false
 EOF
     if [ ! -f "./embedEtcd.yaml" ]
     then
@@ -0,0 +1,102 @@
+# Import required libraries
+import html
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+################################################################################
+# Text cleaning over whole Arrow string arrays
+# Crossref abstracts are JATS XML fragments such as
+#   <jats:title>Abstract</jats:title><jats:p>Text with <jats:italic>markup</jats:italic></jats:p>
+# Every step runs as one Arrow compute call over a batch, no row is parsed on
+# its own except the few carrying character references.
+
+# First paragraph, <p> or a namespaced <jats:p>, with its content in the group
+paragraph_pattern = r"(?s)<(?:\w+:)?p(?:\s[^>]*)?>(?P<paragraph>.*?)</(?:\w+:)?p\s*>"
+
+# Tags that end a block of text or break a line, opening, closing or empty,
+# plain or namespaced as <jats:sec>
+block_tag_pattern = r"</?(?:\w+:)?(?:p|title|br|sec|list|list-item|label|caption|disp-quote|table|tr|td|th)(?:\s[^>]*)?/?>"
+
+# Any tag
+tag_pattern = r"<[^>]*>"
+
+
+def _as_array(array: pa.Array | pa.ChunkedArray) -> pa.Array:
+    return array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+
+
+# Function to extract the text of abstracts
+# Keeps the first paragraph when there is one, as the title of a structured
+# abstract comes before it, otherwise the whole text. Drops the tags, resolves
+# character references and collapses whitespace.
+def strip_markup(array: pa.Array | pa.ChunkedArray) -> pa.Array:
+    array = pc.fill_null(_as_array(array), "")
+
+    paragraph = pc.struct_field(pc.extract_regex(array, paragraph_pattern), [0])
+    text = pc.if_else(pc.is_valid(paragraph), paragraph, array)
+
+    # Block and break tags become a space, so words on either side of <br/> or
+    # </jats:title> stay apart. Inline tags such as <sub>, <sup> or <italic> are
+    # dropped, CO<sub>2</sub> reads CO2. The spaces are collapsed below.
+    text = pc.replace_substring_regex(text, block_tag_pattern, " ")
+    text = pc.replace_substring_regex(text, tag_pattern, "")
+
+    # Character references, &amp; or &#x2013;, only in a few rows so unescape those one by one
+    escaped = pc.match_substring(text, "&")
+    if pc.any(escaped).as_py():
+        positions = np.flatnonzero(escaped.to_numpy(zero_copy_only=False))
+        unescaped = pa.array([html.unescape(value) for value in text.take(positions).to_pylist()], pa.string())
+        mask = np.zeros(len(text), dtype=bool)
+        mask[positions] = True
+        text = pc.replace_with_mask(text, pa.array(mask), unescaped)
+
+    text = pc.replace_substring_regex(text, r"\s+", " ")
+    return pc.utf8_trim_whitespace(text)
+
+
+################################################################################
+# Function to truncate strings to a number of UTF-8 bytes, suffix included
+# Keeps as much text as fits and never cuts a character in half. Works on the
+# offsets and bytes of the array, so a batch costs a few NumPy calls.
+def truncate_utf8(array: pa.Array | pa.ChunkedArray, max_bytes: int, suffix: str = "...") -> pa.Array:
+    array = pc.fill_null(_as_array(array), "")
+
+    # Work on plain string layout, with offsets starting wherever the array does
+    array = array.cast(pa.large_string())
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[array.offset : array.offset + len(array) + 1]
+    data = np.frombuffer(array.buffers()[2], dtype=np.uint8) if len(array) and offsets[-1] > offsets[0] else np.zeros(1, dtype=np.uint8)
+
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    too_long = lengths > max_bytes
+
+    if not too_long.any():
+        return array.cast(pa.string())
+
+    # Where to cut: the budget left for text, moved back off UTF-8 continuation bytes (10xxxxxx)
+    suffix_bytes = len(suffix.encode("utf-8"))
+    cut = starts + max(max_bytes - suffix_bytes, 0)
+    for _ in range(3):
+        inside = too_long & (cut > starts) & ((data[np.minimum(cut, len(data) - 1)] & 0xC0) == 0x80)
+        cut[inside] -= 1
+
+    keep = np.where(too_long, cut - starts, lengths)
+
+    # Gather the kept bytes of every row into one buffer
+    new_offsets = np.zeros(len(array) + 1, dtype=np.int64)
+    np.cumsum(keep, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1], dtype=np.int64) - np.repeat(new_offsets[:-1] - starts, keep)
+    kept = pa.LargeStringArray.from_buffers(
+        len(array), pa.py_buffer(new_offsets), pa.py_buffer(data[positions].tobytes())
+    )
+
+    # Mark what was cut
+    suffixes = pc.if_else(pa.array(too_long), pa.scalar(suffix, pa.large_string()), pa.scalar("", pa.large_string()))
+    return pc.binary_join_element_wise(kept, suffixes, pa.scalar("", pa.large_string())).cast(pa.string())
+
+
+# Function to measure the UTF-8 size of every string
+def utf8_bytes(array: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    return pc.binary_length(pc.fill_null(_as_array(array), "")).to_numpy(zero_copy_only=False)
@@ -0,0 +1,109 @@
+# Import required libraries
+import numpy as np
+import pyarrow as pa
+
+################################################################################
+# Number of dimensions of an embedding
+VECTOR_DIMENSIONS = 1024
+
+# Number of bytes in a packed 1024 bit binary vector
+VECTOR_BYTES = VECTOR_DIMENSIONS // 8
+
+
+################################################################################
+# Function to view a column of packed binary vectors as a (rows, 128) uint8 matrix
+# Handles the ways the vectors end up stored in parquet: binary, large_binary,
+# fixed_size_binary and list<uint8>. Avoids copies where Arrow allows it.
+def binary_vectors_to_matrix(array: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+
+    if array.null_count:
+        raise ValueError(f"Found {array.null_count} missing vectors")
+
+    if len(array) == 0:
+        return np.empty((0, VECTOR_BYTES), dtype=np.uint8)
+
+    array_type = array.type
+
+    if pa.types.is_fixed_size_binary(array_type):
+        width = array_type.byte_width
+        data = np.frombuffer(array.buffers()[1], dtype=np.uint8)
+        data = data[array.offset * width : (array.offset + len(array)) * width]
+
+    elif pa.types.is_binary(array_type) or pa.types.is_large_binary(array_type):
+        offset_type = np.int32 if pa.types.is_binary(array_type) else np.int64
+        offsets = np.frombuffer(array.buffers()[1], dtype=offset_type)
+        offsets = offsets[array.offset : array.offset + len(array) + 1]
+
+        # Every vector must have the same length for the matrix view to be valid
+        if not np.all(np.diff(offsets) == VECTOR_BYTES):
+            raise ValueError(f"Expected every vector to be {VECTOR_BYTES} bytes")
+
+        data = np.frombuffer(array.buffers()[2], dtype=np.uint8)[offsets[0] : offsets[-1]]
+
+    elif pa.types.is_list(array_type) or pa.types.is_large_list(array_type) or pa.types.is_fixed_size_list(array_type):
+        data = array.flatten().to_numpy(zero_copy_only=False).astype(np.uint8, copy=False)
+
+    else:
+        raise TypeError(f"Unsupported vector type: {array_type}")
+
+    return data.reshape(-1, VECTOR_BYTES)
+
+
+################################################################################
+# Function to view a column of float embeddings as a (rows, 1024) float32 matrix
+def float_vectors_to_matrix(array: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+
+    if array.null_count:
+        raise ValueError(f"Found {array.null_count} missing vectors")
+
+    values = array.flatten().to_numpy(zero_copy_only=False).astype(np.float32, copy=False)
+
+    return values.reshape(len(array), -1)
+
+
+# Function to turn a (rows, dimensions) float matrix into a list<float32> column
+# The column shares the matrix buffer, only the list offsets are computed.
+def matrix_to_float_vectors(matrix: np.ndarray) -> pa.Array:
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    values = pa.array(matrix.reshape(-1))
+
+    return pa.FixedSizeListArray.from_arrays(values, matrix.shape[1]).cast(pa.list_(pa.float32()))
+
+
+################################################################################
+# Function to compute the Hamming distance of a packed query to every row of a matrix
+def hamming_distances(matrix: np.ndarray, query: bytes | np.ndarray) -> np.ndarray:
+    query = np.frombuffer(query, dtype=np.uint8) if isinstance(query, bytes) else np.asarray(query, dtype=np.uint8)
+
+    # XOR and popcount 64 bits at a time
+    xor = np.bitwise_xor(matrix.view(np.uint64), query.view(np.uint64))
+
+    return np.bitwise_count(xor).sum(axis=1, dtype=np.int32)
+
+
+################################################################################
+# Function to binarise a batch of float embeddings into packed binary vectors
+# Thresholds the whole matrix at zero and packs 8 dimensions per byte, the same
+# as binarising row by row, without going through Python lists. Returns a
+# fixed_size_binary(128) column, or binary when value_type says so: datasets
+# and the Milvus parquet import read plain binary.
+def binarise_vectors(array: pa.Array | pa.ChunkedArray | np.ndarray, value_type: pa.DataType = pa.binary(VECTOR_BYTES)) -> pa.Array:
+    matrix = array if isinstance(array, np.ndarray) else float_vectors_to_matrix(array)
+
+    packed = np.packbits(matrix >= 0, axis=1)
+
+    binary = pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(packed.shape[1]), len(packed), [None, pa.py_buffer(packed)]
+    )
+
+    return binary if binary.type == value_type else binary.cast(value_type)
+
+
+# Function to binarise the vector column of a table, for batched dataset.map over Arrow
+def binarise_table(table: pa.Table, column: str = "vector", value_type: pa.DataType = pa.binary()) -> pa.Table:
+    index = table.schema.get_field_index(column)
+    return table.set_column(index, column, binarise_vectors(table.column(column), value_type))